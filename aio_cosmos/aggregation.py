@@ -0,0 +1,166 @@
+"""Client-side combination of cross-partition aggregate and DISTINCT queries.
+
+The gateway answers an aggregate query per partition key range, so a cross-partition ``SELECT VALUE COUNT(1)``
+comes back as one partial value per range. These helpers recognise such queries, rewrite them into per-range
+queries and combine the partial results as they arrive.
+"""
+
+import hashlib
+import json
+import re
+from typing import Any, List, Optional, Tuple
+
+_AGGREGATE_RE = re.compile(r'^\s*SELECT\s+(VALUE\s+)?(COUNT|SUM|MIN|MAX|AVG)\s*\(', re.IGNORECASE)
+_ALIAS_RE = re.compile(r'^\s*(?:AS\s+)?([A-Za-z_]\w*)\s+(?=FROM\b)', re.IGNORECASE)
+_FROM_RE = re.compile(r'^\s*FROM\b', re.IGNORECASE)
+_DISTINCT_RE = re.compile(r'^\s*SELECT\s+DISTINCT\b', re.IGNORECASE)
+# keywords directly after a '.' are property names such as c.top
+_UNSUPPORTED_RE = re.compile(r'(?<![.\w])(GROUP\s+BY|ORDER\s+BY|OFFSET|TOP)\b', re.IGNORECASE)
+_STRING_RE = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+
+
+def _unsupported(text: str) -> bool:
+    return _UNSUPPORTED_RE.search(_STRING_RE.sub("''", text)) is not None
+
+
+def _closing_paren(text: str, start: int) -> Optional[int]:
+    depth = 0
+    quote = None
+    for i in range(start, len(text)):
+        char = text[i]
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char in ('"', "'"):
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                return i
+    return None
+
+
+class AggregateQuery:
+
+    def __init__(self, function: str, expression: str, source: str, value: bool, alias: Optional[str]):
+        self.function = function
+        self.expression = expression
+        self.source = source
+        self.value = value
+        self.alias = alias
+
+    def partition_queries(self) -> List[Tuple[str, str]]:
+        """The (aggregate, query) pairs run against each partition key range.
+
+        AVG is computed from a SUM and a COUNT as per-range averages cannot be combined.
+        """
+        functions = ('SUM', 'COUNT') if self.function == 'AVG' else (self.function,)
+        return [(f, f'SELECT VALUE {f}({self.expression}) {self.source}') for f in functions]
+
+    def format(self, value: Any) -> List[Any]:
+        if value is None:
+            return []
+        return [value] if self.value else [{self.alias or '$1': value}]
+
+
+def parse_aggregate_query(query: str) -> Optional[AggregateQuery]:
+    """Recognise a query whose projection is a single aggregate, e.g. ``SELECT VALUE COUNT(1) FROM c``.
+    """
+    match = _AGGREGATE_RE.match(query)
+    if match is None:
+        return None
+
+    end = _closing_paren(query, match.end() - 1)
+    if end is None:
+        return None
+
+    rest = query[end + 1:]
+    alias = None
+    alias_match = _ALIAS_RE.match(rest)
+    if alias_match is not None:
+        if match.group(1):
+            return None
+        alias = alias_match.group(1)
+        rest = rest[alias_match.end():]
+
+    if _FROM_RE.match(rest) is None or _unsupported(rest):
+        return None
+
+    return AggregateQuery(match.group(2).upper(), query[match.end():end].strip(), rest.strip(),
+                          value=bool(match.group(1)), alias=alias)
+
+
+def is_distinct_query(query: str) -> bool:
+    return _DISTINCT_RE.match(query) is not None and not _unsupported(query)
+
+
+def _order_key(value: Any):
+    # Cosmos orders null < booleans < numbers < strings
+    if value is None:
+        return 0, 0
+    if isinstance(value, bool):
+        return 1, value
+    if isinstance(value, (int, float)):
+        return 2, value
+    return 3, value
+
+
+class Aggregator:
+
+    def __init__(self, function: str):
+        self.function = function
+        self.value = None
+        self.sum = 0
+        self.count = 0
+
+    def add(self, partial: Any, function: Optional[str] = None):
+        """Fold in one partition's partial result, ``function`` is the partition query's aggregate for AVG.
+        """
+        if self.function == 'COUNT':
+            self.count += partial
+        elif self.function == 'AVG':
+            if function == 'COUNT':
+                self.count += partial
+            else:
+                self.sum += partial
+        elif self.function == 'SUM':
+            self.value = partial if self.value is None else self.value + partial
+        elif isinstance(partial, (list, dict)):
+            return
+        elif self.value is None:
+            self.value = partial
+        elif self.function == 'MIN':
+            self.value = min(self.value, partial, key=_order_key)
+        else:
+            self.value = max(self.value, partial, key=_order_key)
+
+    def result(self) -> Any:
+        if self.function == 'COUNT':
+            return self.count
+        if self.function == 'AVG':
+            return self.sum / self.count if self.count else None
+        return self.value
+
+
+class DistinctFilter:
+
+    def __init__(self, max_values: int = 1000000):
+        """
+        :param max_values: the most distinct values tracked; only a 16 byte digest of each is held
+        """
+        self.max_values = max_values
+        self.seen = set()
+
+    def add(self, value: Any) -> bool:
+        """Return True the first time a value is seen.
+        """
+        digest = hashlib.blake2b(json.dumps(value, sort_keys=True, separators=(',', ':')).encode('utf-8'),
+                                 digest_size=16).digest()
+        if digest in self.seen:
+            return False
+        if len(self.seen) >= self.max_values:
+            raise OverflowError(f'DISTINCT query returned more than {self.max_values} values')
+        self.seen.add(digest)
+        return True
@@ -0,0 +1,109 @@
+"""Per-endpoint circuit breakers.
+
+Each regional endpoint gets its own breaker. After ``failure_threshold`` consecutive timeouts, connection errors or
+server errors the breaker opens and requests to that endpoint fail fast (or go to another endpoint) until
+``reset_timeout`` has passed, after which a single probe request is let through to decide whether to close it again.
+"""
+
+import time
+from typing import Any, Dict, Optional
+
+from yarl import URL
+
+
+class CircuitState(object):
+    """States of a circuit breaker.
+    """
+
+    Closed = "closed"
+    Open = "open"
+    HalfOpen = "half-open"
+
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitState.Closed
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.trips = 0
+        self.rejected = 0
+
+    def _can_probe(self) -> bool:
+        return time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def available(self) -> bool:
+        """Whether a request could currently be sent to this endpoint, without claiming the half-open probe.
+        """
+        if self.state == CircuitState.Closed:
+            return True
+        if self.state == CircuitState.Open:
+            return self._can_probe()
+        return not self.probing
+
+    def acquire(self) -> bool:
+        if self.state == CircuitState.Closed:
+            return True
+        if self.state == CircuitState.Open and self._can_probe():
+            self.state = CircuitState.HalfOpen
+        if self.state == CircuitState.HalfOpen and not self.probing:
+            self.probing = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        self.state = CircuitState.Closed
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == CircuitState.HalfOpen or self.failures >= self.failure_threshold:
+            if self.state != CircuitState.Open:
+                self.trips += 1
+            self.state = CircuitState.Open
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+    def release(self):
+        """Give up a half-open probe that was cancelled before it produced a result.
+        """
+        self.probing = False
+
+
+class CircuitBreakerPolicy:
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, min_attempt_timeout: float = 0.5):
+        """
+        :param failure_threshold: consecutive failures after which an endpoint's breaker opens
+        :param reset_timeout: seconds an open breaker waits before letting a probe request through
+        :param min_attempt_timeout: a timeout only counts as a failure of the endpoint when the request had at
+            least this many seconds, shorter deadlines say more about the caller than the endpoint
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.min_attempt_timeout = min_attempt_timeout
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, url: str) -> CircuitBreaker:
+        origin = str(URL(url).origin())
+        if origin not in self.breakers:
+            self.breakers[origin] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+        return self.breakers[origin]
+
+    def counts_timeout(self, budget: Optional[float]) -> bool:
+        return budget is None or budget >= self.min_attempt_timeout
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            origin: {
+                'state': b.state,
+                'failures': b.failures,
+                'trips': b.trips,
+                'rejected': b.rejected
+            } for origin, b in self.breakers.items()
+        }
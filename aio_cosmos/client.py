@@ -1,6 +1,16 @@
 import asyncio
+import json as jsonlib
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor
 
 from . import auth, http_constants
+from .aggregation import AggregateQuery, Aggregator, DistinctFilter, is_distinct_query, parse_aggregate_query
+from .circuit import CircuitBreakerPolicy
+from .hedging import HedgingPolicy
+from .limiter import Priority, RULimiter
+from .metadata import MetadataCache, get_partition_key_value
+from .query_metrics import QueryMetrics, parse_index_metrics
+from .writer import WriteCoalescer
 from aio_cosmos import __version__, __cosmos_api_version__
 
 from datetime import datetime
@@ -8,8 +18,9 @@ from datetime import datetime
 import aiohttp
 from aiohttp.client_reqrep import ClientResponse
 
-from typing import Optional, Union, Any, AsyncGenerator, Dict, List, Tuple
+from typing import Optional, Union, Any, AsyncGenerator, Callable, Dict, List, Tuple
 import random
+import re
 
 from contextlib import asynccontextmanager
 
@@ -26,7 +37,19 @@ class CosmosError(Exception):
         super().__init__(self.message)
 
     def __repr__(self) -> str:
-        return f'CosmosError HTTP{self.http_status_code}: {self.response["Message"]}'
+        return f'CosmosError HTTP{self.http_status_code}: {self.response.get("Message", self.message)}'
+
+
+class CosmosTimeoutError(CosmosError, asyncio.TimeoutError):
+
+    def __init__(self, message: str):
+        super().__init__(http_constants.StatusCodes.REQUEST_TIMEOUT, {}, message)
+
+
+class CircuitOpenError(CosmosError):
+
+    def __init__(self, message: str):
+        super().__init__(http_constants.StatusCodes.SERVICE_UNAVAILABLE, {}, message)
 
 
 DEFAULT_HEADERS = {
@@ -53,6 +76,30 @@ def is_master_resource(resourceType):
     )
 
 
+def decode_json(body: bytes) -> Any:
+    return jsonlib.loads(body) if body.strip() else None
+
+
+_LITERAL_RE = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|\b\d+(?:\.\d+)?\b")
+
+
+def query_shape(query: str) -> str:
+    """The query with its literal values replaced, so queries differing only in values share RU and latency history.
+    """
+    return ' '.join(_LITERAL_RE.sub('?', query).split()).lower()
+
+
+def encode_json_batch(documents: List[Dict[str, Any]]) -> List[bytes]:
+    return [jsonlib.dumps(document).encode('utf-8') for document in documents]
+
+
+def use_uvloop():
+    """Install the uvloop event loop policy, requires the uvloop extra.
+    """
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
 async def on_request_end(session, trace_config_ctx, params):
     print("Ending %s request for %s. I sent: %s" % (params.method, params.url, params.headers))
     print('Sent headers: %s' % params.response.request_info.headers)
@@ -60,7 +107,17 @@ async def on_request_end(session, trace_config_ctx, params):
 
 class CosmosClient:
 
-    def __init__(self, endpoint: str, master_key: str, debug: bool = False, raise_on_failure: bool = True):
+    def __init__(self, endpoint: str, master_key: str, debug: bool = False, raise_on_failure: bool = True,
+                 ru_limiter: Optional[RULimiter] = None,
+                 hedging: Optional[HedgingPolicy] = None,
+                 timeout: Optional[float] = None,
+                 circuit_breaker: Optional[CircuitBreakerPolicy] = None,
+                 max_retries: int = 0,
+                 metadata_ttl: Optional[float] = 300.0,
+                 offload_threshold: Optional[int] = None,
+                 offload_executor: Optional[Executor] = None,
+                 offload_workers: int = 4,
+                 no_response_on_write: bool = False):
         self.endpoint = endpoint if endpoint.endswith('/') else endpoint + '/'
         self.writable_endpoints = [{'databaseAccountEndpoint': self.endpoint}]
         self.readable_endpoints = [{'databaseAccountEndpoint': self.endpoint}]
@@ -68,6 +125,18 @@ class CosmosClient:
         self.master_key = master_key
         self.session_token = None
         self.raise_on_failure = raise_on_failure
+        self.ru_limiter = ru_limiter
+        self.hedging = hedging
+        self.timeout = timeout
+        self.circuit_breaker = circuit_breaker
+        self.max_retries = max_retries
+        self.metadata = MetadataCache(self, ttl=metadata_ttl)
+        self.offload_threshold = offload_threshold
+        self.offload_executor = offload_executor
+        self.offload_workers = offload_workers
+        self._owns_executor = False
+        self.writer: Optional[WriteCoalescer] = None
+        self.no_response_on_write = no_response_on_write
         if debug:
             trace_config = aiohttp.TraceConfig()
             trace_config.on_request_end.append(on_request_end)
@@ -77,21 +146,291 @@ class CosmosClient:
             self.session = aiohttp.ClientSession(raise_for_status=False)
 
     async def connect(self):
-        headers = self._get_headers(http_constants.HttpMethods.Get, None, "")
-
-        async with self.session.get(self.endpoint, headers=headers) as response:
-            self.server_details = await response.json()
-            self.writable_endpoints = self.server_details['writableLocations']
-            self.readable_endpoints = self.server_details['readableLocations']
+        await self.metadata.account()
+        self.metadata.start()
+
+    def enable_write_coalescing(self, max_batch: int = 50, max_delay: float = 0.005,
+                                max_concurrent_flushes: int = 10,
+                                max_queued_batches: int = 100,
+                                priority: str = Priority.Interactive) -> WriteCoalescer:
+        # a writer may already hold queued writes, so it is kept rather than replaced
+        if self.writer is None:
+            self.writer = WriteCoalescer(self, max_batch=max_batch, max_delay=max_delay,
+                                         max_concurrent_flushes=max_concurrent_flushes,
+                                         max_queued_batches=max_queued_batches, priority=priority)
+        return self.writer
 
     async def close(self):
+        if self.writer is not None:
+            await self.writer.close()
+        await self.metadata.stop()
         await self.session.close()
+        if self._owns_executor:
+            self.offload_executor.shutdown(wait=False)
+            self.offload_executor = None
+            self._owns_executor = False
+
+    def _get_offload_executor(self) -> Executor:
+        # json decoding holds the GIL, so only a process pool actually takes the work off the loop's thread. The
+        # workers are spawned rather than forked as the pool is created lazily in a process already running threads.
+        if self.offload_executor is None:
+            self.offload_executor = ProcessPoolExecutor(max_workers=self.offload_workers,
+                                                        mp_context=multiprocessing.get_context('spawn'))
+            self._owns_executor = True
+        return self.offload_executor
+
+    async def _offload(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._get_offload_executor(), func, *args)
+
+    async def _decode(self, response: ClientResponse) -> Any:
+        body = await response.read()
+        # large bodies are decoded in the pool so they don't stall every other request on the loop
+        if self.offload_threshold is not None and len(body) >= self.offload_threshold:
+            return await self._offload(decode_json, body)
+        return decode_json(body)
+
+    async def get_database_account(self) -> Dict[str, Any]:
+        headers = self._get_headers(http_constants.HttpMethods.Get, None, "")
+        kwargs = {'timeout': aiohttp.ClientTimeout(total=self.timeout)} if self.timeout is not None else {}
+
+        # the account is always read through the global endpoint, the regional ones may be what has changed
+        async with self.session.get(self.endpoint, headers=headers, **kwargs) as response:
+            return await self._handle_response(response, 'Could not read database account')
+
+    def _available(self, endpoints: List[Dict[str, Any]]) -> List[str]:
+        endpoints = [e['databaseAccountEndpoint'] for e in endpoints]
+        if self.circuit_breaker is None:
+            return endpoints
+        available = [e for e in endpoints if self.circuit_breaker.get(e).available()]
+        if not available:
+            self.metadata.invalidate('account')
+            raise CircuitOpenError(f'All endpoints are unavailable: {", ".join(endpoints)}')
+        return available
 
     def _get_readable(self):
-        return random.choice(self.readable_endpoints)['databaseAccountEndpoint']
+        return random.choice(self._available(self.readable_endpoints))
 
     def _get_writable(self):
-        return random.choice(self.readable_endpoints)['databaseAccountEndpoint']
+        return random.choice(self._available(self.writable_endpoints))
+
+    @staticmethod
+    def _url(endpoint: str, path: str) -> str:
+        return endpoint.rstrip('/') + '/' + path
+
+    def _get_hedge_endpoints(self, primary: str) -> List[str]:
+        return [primary] + [e for e in self._available(self.readable_endpoints) if e != primary]
+
+    @staticmethod
+    def _remaining(deadline: Optional[float]) -> Optional[float]:
+        if deadline is None:
+            return None
+        remaining = deadline - asyncio.get_event_loop().time()
+        if remaining <= 0:
+            raise CosmosTimeoutError('Deadline exceeded')
+        return remaining
+
+    async def _within(self, deadline: Optional[float], awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self._remaining(deadline))
+        except asyncio.TimeoutError as e:
+            if isinstance(e, CosmosError):
+                raise
+            raise CosmosTimeoutError('Deadline exceeded') from e
+
+    def _record_outcome(self, url: str, failed: bool):
+        if self.circuit_breaker is None:
+            return
+        breaker = self.circuit_breaker.get(url)
+        if failed:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+    def _record_timeout(self, url: str, budget: Optional[float]):
+        if self.circuit_breaker is None:
+            return
+        breaker = self.circuit_breaker.get(url)
+        if self.circuit_breaker.counts_timeout(budget):
+            breaker.record_failure()
+        else:
+            # the caller's deadline was too short to say anything about the endpoint
+            breaker.release()
+
+    @asynccontextmanager
+    async def _request(self, method: str, path: str, operation: str,
+                       priority: str = Priority.Interactive, read: bool = False,
+                       timeout: Optional[float] = None, **kwargs) -> ClientResponse:
+        timeout = timeout if timeout is not None else self.timeout
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+
+        attempt = 0
+        while True:
+            try:
+                response = await self._send(method, path, operation, priority, read, deadline, **kwargs)
+            except aiohttp.ClientConnectionError:
+                # reads are safe to send again, writes may already have been applied
+                if not read or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                continue
+
+            if response.status == http_constants.StatusCodes.TOO_MANY_REQUESTS and attempt < self.max_retries:
+                retry_after = float(response.headers.get(http_constants.HttpHeaders.RetryAfterInMilliseconds, 0))
+                if deadline is None or loop.time() + retry_after / 1000 < deadline:
+                    response.release()
+                    attempt += 1
+                    await asyncio.sleep(retry_after / 1000)
+                    continue
+            break
+
+        try:
+            yield response
+        except asyncio.TimeoutError as e:
+            # the deadline ran out while the body was being read
+            response.close()
+            self._record_timeout(str(response.url), timeout)
+            if isinstance(e, CosmosError):
+                raise
+            raise CosmosTimeoutError(f'Deadline exceeded reading response from {response.url.origin()}') from e
+        except BaseException:
+            # never hand a connection with a partly read body back to the pool
+            response.close()
+            raise
+        finally:
+            response.release()
+
+    async def _send(self, method: str, path: str, operation: str, priority: str, read: bool,
+                    deadline: Optional[float], **kwargs) -> ClientResponse:
+        estimated = None
+        if self.ru_limiter is not None:
+            estimated = await self._within(deadline, self.ru_limiter.acquire(operation, priority))
+
+        try:
+            if read and self.hedging is not None:
+                # every request the hedge sends, the primary included, is settled against the budget there
+                charged, estimated = estimated, None
+                return await self._send_hedged(method, path, operation, deadline, charged, **kwargs)
+            else:
+                endpoint = self._get_readable() if read else self._get_writable()
+                response = await self._send_to(endpoint, method, path, deadline, **kwargs)
+
+            if estimated is not None:
+                self._record_charge(operation, estimated, response)
+                estimated = None
+            return response
+        finally:
+            # the request never produced a response, so give its estimate back to the budget
+            if estimated is not None:
+                self.ru_limiter.release(estimated)
+
+    async def _send_to(self, endpoint: str, method: str, path: str, deadline: Optional[float],
+                       **kwargs) -> ClientResponse:
+        url = self._url(endpoint, path)
+        remaining = self._remaining(deadline)
+        if remaining is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=remaining)
+
+        breaker = self.circuit_breaker.get(url) if self.circuit_breaker is not None else None
+        if breaker is not None and not breaker.acquire():
+            raise CircuitOpenError(f'Circuit open for endpoint {endpoint}')
+
+        try:
+            response = await self.session.request(method, url, **kwargs)
+        except asyncio.TimeoutError as e:
+            self._record_timeout(url, remaining)
+            raise CosmosTimeoutError(f'Deadline exceeded waiting for {endpoint}') from e
+        except aiohttp.ClientConnectionError:
+            self._record_outcome(url, failed=True)
+            raise
+        except BaseException:
+            if breaker is not None:
+                breaker.release()
+            raise
+
+        self._record_outcome(url, failed=response.status >= http_constants.StatusCodes.INTERNAL_SERVER_ERROR or
+                             response.status == http_constants.StatusCodes.REQUEST_TIMEOUT)
+        if response.status >= 400:
+            substatus = response.headers.get(http_constants.HttpHeaders.SubStatus)
+            self.metadata.on_response(path, response.status, int(substatus) if substatus is not None else None)
+        return response
+
+    async def _send_hedged(self, method: str, path: str, operation: str, deadline: Optional[float],
+                           estimated: Optional[float], **kwargs) -> ClientResponse:
+        policy = self.hedging
+        endpoints = self._get_hedge_endpoints(self._get_readable())
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        threshold = policy.threshold(operation)
+        policy.requests += 1
+
+        tasks = [asyncio.ensure_future(self._send_to(endpoints[0], method, path, deadline, **kwargs))]
+        estimates = [estimated]
+        can_hedge = policy.max_hedges > 0
+        winner = None
+        try:
+            while winner is None:
+                pending = [t for t in tasks if not t.done()]
+                if not pending:
+                    break
+
+                timeout = None
+                if can_hedge:
+                    timeout = max(start + threshold * len(tasks) - loop.time(), 0)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    if policy.allow_hedge():
+                        endpoint = endpoints[len(tasks) % len(endpoints)]
+                        tasks.append(asyncio.ensure_future(
+                            self._send_to(endpoint, method, path, deadline, **kwargs)))
+                        estimates.append(self.ru_limiter.take(operation) if estimated is not None else None)
+                        policy.hedges += 1
+                        can_hedge = len(tasks) <= policy.max_hedges
+                    else:
+                        can_hedge = False
+                    continue
+
+                for task in tasks:
+                    if task in done and task.exception() is None and policy.acceptable(task.result()):
+                        winner = task
+                        break
+
+            if winner is None:
+                # nothing usable came back, surface the primary's outcome as if no hedge had been sent
+                winner = tasks[0]
+
+            if winner is not tasks[0]:
+                policy.hedge_wins += 1
+            if winner.exception() is None:
+                policy.record(operation, loop.time() - start)
+            return winner.result()
+        finally:
+            for task, estimate in zip(tasks, estimates):
+                response = None
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    response = task.result()
+
+                if estimate is not None:
+                    if response is not None:
+                        self._record_charge(operation, estimate, response)
+                    elif task is tasks[0]:
+                        self.ru_limiter.release(estimate)
+                    # a cancelled hedge may still have run on the server, so its estimate stays charged
+
+                if response is not None and task is not winner:
+                    response.close()
+
+    def _record_charge(self, operation: str, estimated: float, response: ClientResponse):
+        charge = response.headers.get(http_constants.HttpHeaders.RequestCharge)
+        retry_after = None
+        if response.status == http_constants.StatusCodes.TOO_MANY_REQUESTS:
+            retry_after = response.headers.get(http_constants.HttpHeaders.RetryAfterInMilliseconds)
+        self.ru_limiter.record(operation, estimated,
+                               float(charge) if charge is not None else None,
+                               float(retry_after) if retry_after is not None else None)
 
     def _get_headers(self,
                      method: str,
@@ -102,7 +441,8 @@ class CosmosClient:
                      autoscale_ceiling: Optional[int] = None,
                      upsert: Optional[bool] = None,
                      indexed: Optional[bool] = None,
-                     session_token: Optional[str] = None):
+                     session_token: Optional[str] = None,
+                     no_response: bool = False):
         headers = DEFAULT_HEADERS.copy()
 
         if session_token is not None and not is_master_resource(resource_type):
@@ -119,6 +459,9 @@ class CosmosClient:
         if indexed is not None:
             headers[http_constants.HttpHeaders.IndexingDirective] = "Include" if indexed else "Exclude"
 
+        if no_response:
+            headers[http_constants.HttpHeaders.Prefer] = 'return=minimal'
+
         if throughput is not None and autoscale_ceiling is not None:
             raise CosmosError('Only one of throughput or autoscale_ceiling can be specified')
 
@@ -139,8 +482,23 @@ class CosmosClient:
                                response: ClientResponse,
                                error_message: str,
                                manage_session: bool = False,
-                               subkey: Optional[str] = None):
-        data = await response.json()
+                               subkey: Optional[str] = None,
+                               no_response: bool = False):
+        if no_response and response.status < 400:
+            # drained rather than decoded so the connection can be reused should the gateway send a body anyway
+            await response.read()
+            return {
+                'status': 'ok',
+                'code': response.status,
+                'session_token': self._update_session(response) if manage_session
+                else response.headers.get(http_constants.HttpHeaders.SessionToken),
+                'error': None,
+                'etag': response.headers.get(http_constants.HttpHeaders.ETag),
+                'request_charge': self._request_charge(response),
+                'data': None
+            }
+
+        data = await self._decode(response)
 
         if response.status >= 400 and self.raise_on_failure:
             if self.raise_on_failure:
@@ -148,21 +506,36 @@ class CosmosClient:
 
         session_token = None
         if manage_session:
-            self.session_token = response.headers.get(http_constants.HttpHeaders.SessionToken)
-            session_token = self.session_token
+            session_token = self._update_session(response)
 
         return {
             'status': 'failed' if response.status >= 400 else 'ok',
             'code': response.status,
             'session_token': session_token,
             'error': error_message if response.status >= 400 else None,
-            'data': data[subkey] if subkey is not None else data
+            'request_charge': self._request_charge(response),
+            'data': data[subkey] if subkey is not None and response.status < 400 else data
         }
 
+    @staticmethod
+    def _request_charge(response: ClientResponse) -> float:
+        return float(response.headers.get(http_constants.HttpHeaders.RequestCharge, 0))
+
+    def _update_session(self, response: ClientResponse) -> Optional[str]:
+        # a response without a token, e.g. an error in a concurrent batch, keeps the last one seen
+        session_token = response.headers.get(http_constants.HttpHeaders.SessionToken)
+        if session_token is not None:
+            self.session_token = session_token
+        return session_token
+
+    def _no_response(self, no_response: Optional[bool]) -> bool:
+        return self.no_response_on_write if no_response is None else no_response
+
     async def list_databases(self):
         headers = self._get_headers(http_constants.HttpMethods.Get, None, "dbs")
 
-        async with self.session.get(f'{self._get_writable()}/dbs', headers=headers) as response:
+        async with self._request(http_constants.HttpMethods.Get, 'dbs', 'list_databases',
+                                 headers=headers) as response:
             return await self._handle_response(response, 'Could not list databases')
 
     async def create_database(self, name: str,
@@ -171,13 +544,15 @@ class CosmosClient:
         headers = self._get_headers(http_constants.HttpMethods.Post, None, "dbs",
                                     throughput=throughput, autoscale_ceiling=autoscale_ceiling)
 
-        async with self.session.post(f'{self._get_writable()}/dbs', headers=headers, json={"id": name}) as response:
+        async with self._request(http_constants.HttpMethods.Post, 'dbs', 'create_database',
+                                 headers=headers, json={"id": name}) as response:
             return await self._handle_response(response, f"Could not create database: {name}")
 
     async def delete_database(self, name: str) -> Dict[str, Any]:
         headers = self._get_headers(http_constants.HttpMethods.Delete, f"dbs/{name}", "dbs")
 
-        async with self.session.delete(f'{self._get_writable()}/dbs/{name}', headers=headers, ) as response:
+        async with self._request(http_constants.HttpMethods.Delete, f'dbs/{name}', 'delete_database',
+                                 headers=headers) as response:
             return await self._handle_response(response, f"Could not delete database: {name}")
 
     async def create_container(self, database: str,
@@ -199,110 +574,344 @@ class CosmosClient:
             }
         }
 
-        async with self.session.post(f'{self._get_writable()}/dbs/{database}/colls/', headers=headers,
-                                     json=json) as response:
+        async with self._request(http_constants.HttpMethods.Post, f'dbs/{database}/colls/', 'create_container',
+                                 headers=headers, json=json) as response:
             return await self._handle_response(response, f"Could not create container: {database}:{container}")
 
+    async def get_container(self, database: str, container: str) -> Dict[str, Any]:
+        headers = self._get_headers(http_constants.HttpMethods.Get, f'dbs/{database}/colls/{container}', 'colls')
+
+        async with self._request(http_constants.HttpMethods.Get, f'dbs/{database}/colls/{container}',
+                                 'get_container', read=True, headers=headers) as response:
+            return await self._handle_response(response, f"Could not get container: {database}:{container}")
+
     async def delete_container(self, database: str, container: str) -> Dict[str, Any]:
         headers = self._get_headers(http_constants.HttpMethods.Delete, f'dbs/{database}/colls/{container}', 'colls')
 
-        async with self.session.delete(f'{self._get_writable()}/dbs/{database}/colls/{container}/',
-                                       headers=headers) as response:
+        async with self._request(http_constants.HttpMethods.Delete, f'dbs/{database}/colls/{container}/',
+                                 'delete_container', headers=headers) as response:
             return await self._handle_response(response, f"Could not delete container: {database}:{container}")
 
     async def create_document(self, database: str,
                               container: str,
                               json: dict,
-                              partition_key: Any,
+                              partition_key: Any = None,
                               upsert: Optional[bool] = None,
                               indexed: Optional[bool] = None,
-                              session_token: Optional[str] = None) -> Dict[str, Any]:
+                              session_token: Optional[str] = None,
+                              priority: str = Priority.Interactive,
+                              timeout: Optional[float] = None,
+                              no_response: Optional[bool] = None) -> Dict[str, Any]:
+        no_response = self._no_response(no_response)
         headers = self._get_headers(http_constants.HttpMethods.Post, f'dbs/{database}/colls/{container}', 'docs',
                                     upsert=upsert, indexed=indexed,
-                                    session_token=session_token if session_token is not None else self.session_token)
-        headers[http_constants.HttpHeaders.PartitionKey] = f'["{partition_key}"]'
-
-        async with self.session.post(f'{self._get_writable()}/dbs/{database}/colls/{container}/docs',
-                                     headers=headers, json=json) as response:
+                                    session_token=session_token if session_token is not None else self.session_token,
+                                    no_response=no_response)
+        if partition_key is None:
+            partition_key = get_partition_key_value(json, await self.metadata.partition_key_path(database, container))
+        headers[http_constants.HttpHeaders.PartitionKey] = jsonlib.dumps([partition_key])
+
+        async with self._request(http_constants.HttpMethods.Post, f'dbs/{database}/colls/{container}/docs',
+                                 f'create_document:{database}/{container}', priority, timeout=timeout,
+                                 headers=headers, json=json) as response:
             return await self._handle_response(response, f"Could not create document in {database}:{container}",
-                                               manage_session=True)
+                                               manage_session=True, no_response=no_response)
 
     async def create_documents(self, database: str,
                                container: str,
-                               json: List[Tuple[Dict[str, Any], Any]],
+                               json: List[Union[Dict[str, Any], Tuple[Dict[str, Any], Any]]],
                                upsert: Optional[bool] = None,
                                indexed: Optional[bool] = None,
-                               session_token: Optional[str] = None) -> List[Dict[str, Any]]:
+                               session_token: Optional[str] = None,
+                               priority: str = Priority.Background,
+                               timeout: Optional[float] = None,
+                               return_exceptions: bool = False,
+                               no_response: Optional[bool] = None,
+                               manage_session: bool = False) -> List[Dict[str, Any]]:
+        no_response = self._no_response(no_response)
         headers = self._get_headers(http_constants.HttpMethods.Post, f'dbs/{database}/colls/{container}', 'docs',
                                     upsert=upsert, indexed=indexed,
-                                    session_token=session_token if session_token is not None else self.session_token)
+                                    session_token=session_token if session_token is not None else self.session_token,
+                                    no_response=no_response)
 
         # See if we can avoid creating new headers and auth sig for each request or managing the session
         # TODO: need to test this works for large datasets as the http date may get out of sync
-        async def write_document(jsondoc: Tuple[Dict[str, Any], Any], header_copy: dict) -> Dict[str, Any]:
-            body, partition_key = jsondoc
-            headers[http_constants.HttpHeaders.PartitionKey] = f'["{partition_key}"]'
-            async with self.session.post(f'{self._get_writable()}/dbs/{database}/colls/{container}/docs',
-                                         headers=headers, json=body) as response:
+        partition_key_path = None
+        if any(not isinstance(x, tuple) for x in json):
+            partition_key_path = await self.metadata.partition_key_path(database, container)
+
+        documents = [x if isinstance(x, tuple) else (x, get_partition_key_value(x, partition_key_path)) for x in json]
+
+        # serialising a large batch is done in one pass in the pool rather than per request on the loop, the size
+        # is estimated from the first document as shipping a small batch to the pool costs more than encoding it
+        encoded = None
+        if self.offload_threshold is not None and documents and \
+                len(jsonlib.dumps(documents[0][0])) * len(documents) >= self.offload_threshold:
+            encoded = await self._offload(encode_json_batch, [body for body, _ in documents])
+
+        async def write_document(index: int, header_copy: dict) -> Dict[str, Any]:
+            body, partition_key = documents[index]
+            header_copy[http_constants.HttpHeaders.PartitionKey] = jsonlib.dumps([partition_key])
+            if encoded is not None:
+                header_copy[http_constants.HttpHeaders.ContentType] = 'application/json'
+                kwargs = {'data': encoded[index]}
+            else:
+                kwargs = {'json': body}
+            async with self._request(http_constants.HttpMethods.Post, f'dbs/{database}/colls/{container}/docs',
+                                     f'create_document:{database}/{container}', priority, timeout=timeout,
+                                     headers=header_copy, **kwargs) as response:
                 return await self._handle_response(response, f"Could not create document in {database}:{container}",
-                                                   manage_session=False)
+                                                   manage_session=manage_session, no_response=no_response)
 
-        return await asyncio.gather(*[write_document(x, headers.copy()) for x in json])
+        return await asyncio.gather(*[write_document(i, headers.copy()) for i in range(len(documents))],
+                                    return_exceptions=return_exceptions)
 
-    async def delete_document(self, database: str, container: str, doc_id: str, partition_key: Any) -> Dict[str, Any]:
+    async def delete_document(self, database: str, container: str, doc_id: str, partition_key: Any,
+                              priority: str = Priority.Interactive,
+                              timeout: Optional[float] = None) -> Dict[str, Any]:
         headers = self._get_headers(http_constants.HttpMethods.Delete,
                                     f'dbs/{database}/colls/{container}/docs/{doc_id}', 'docs')
-        headers[http_constants.HttpHeaders.PartitionKey] = f'["{partition_key}"]'
+        headers[http_constants.HttpHeaders.PartitionKey] = jsonlib.dumps([partition_key])
 
-        async with self.session.delete(f'{self._get_writable()}/dbs/{database}/colls/{container}/docs/{doc_id}',
-                                       headers=headers) as response:
+        async with self._request(http_constants.HttpMethods.Delete, f'dbs/{database}/colls/{container}/docs/{doc_id}',
+                                 f'delete_document:{database}/{container}', priority, timeout=timeout,
+                                 headers=headers) as response:
             return await self._handle_response(response, f"Could not delete document: {database}:{container}:{doc_id}",
                                                manage_session=True)
 
-    async def get_document(self, database: str, container: str, doc_id: str, partition_key: Any) -> Dict[str, Any]:
+    async def delete_documents(self, database: str,
+                               container: str,
+                               query: Optional[str] = None,
+                               partition_key: Optional[Any] = None,
+                               max_concurrency: int = 20,
+                               page_size: int = 1000,
+                               priority: str = Priority.Background,
+                               timeout: Optional[float] = None,
+                               max_throttle_retries: int = 10,
+                               on_progress: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+        """Delete every document matched by a query, or every document in a partition.
+
+        Matching ids are streamed a page at a time and deleted with at most max_concurrency deletes in flight, so
+        memory is bounded by one query page whatever the number of documents. A query run across partitions must
+        project the id and the partition key path, e.g. ``SELECT c.id, c.account FROM c WHERE c.closed``.
+        """
+        if query is None and partition_key is None:
+            raise ValueError('delete_documents needs a query or a partition key')
+
+        stats = {
+            'status': 'ok',
+            'matched': 0,
+            'deleted': 0,
+            'not_found': 0,
+            'errors': 0,
+            'throttled': 0,
+            'request_charge': 0.0,
+            'error': None
+        }
+
+        partition_key_path = None
+        if partition_key is None:
+            partition_key_path = await self.metadata.partition_key_path(database, container)
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+        pending = set()
+
+        def fail(error: str):
+            stats['errors'] += 1
+            if stats['error'] is None:
+                stats['status'] = 'failed'
+                stats['error'] = error
+
+        async def delete(doc_id: str, doc_partition_key: Any):
+            # sent through _request rather than delete_document so the charge and retry-after of every response
+            # are seen, whether or not the client raises on failures
+            path = f'dbs/{database}/colls/{container}/docs/{doc_id}'
+            try:
+                for attempt in range(max_throttle_retries + 1):
+                    headers = self._get_headers(http_constants.HttpMethods.Delete, path, 'docs')
+                    headers[http_constants.HttpHeaders.PartitionKey] = jsonlib.dumps([doc_partition_key])
+                    async with self._request(http_constants.HttpMethods.Delete, path,
+                                             f'delete_document:{database}/{container}', priority, timeout=timeout,
+                                             headers=headers) as response:
+                        body = await response.read()
+                        status = response.status
+                        stats['request_charge'] += self._request_charge(response)
+                        retry_after = response.headers.get(http_constants.HttpHeaders.RetryAfterInMilliseconds)
+                        if status < 400:
+                            self._update_session(response)
+
+                    if status != http_constants.StatusCodes.TOO_MANY_REQUESTS or attempt == max_throttle_retries:
+                        break
+                    # throttled after the client's own retries, wait as long as the server asked before retrying
+                    stats['throttled'] += 1
+                    await asyncio.sleep(float(retry_after) / 1000 if retry_after is not None
+                                        else min(0.1 * 2 ** attempt, 5.0))
+
+                if status < 400:
+                    stats['deleted'] += 1
+                elif status == http_constants.StatusCodes.NOT_FOUND:
+                    # already gone, which is the outcome asked for
+                    stats['not_found'] += 1
+                else:
+                    fail(f'Could not delete document: {database}:{container}:{doc_id}: HTTP {status} '
+                         f'{body.decode("utf-8", "replace")}')
+            except Exception as e:
+                fail(f'Could not delete document: {database}:{container}:{doc_id}: {e!r}')
+            finally:
+                semaphore.release()
+
+        try:
+            async for page in self.query_documents(database, container, query or 'SELECT c.id FROM c',
+                                                   partition_key=partition_key,
+                                                   enable_cross_partition_query=partition_key is None,
+                                                   max_item_count=page_size, priority=priority, timeout=timeout):
+                stats['request_charge'] += page['request_charge']
+                if page['status'] == 'failed':
+                    stats['status'] = 'failed'
+                    stats['error'] = stats['error'] or page['error']
+                    break
+
+                for doc in page['data']:
+                    stats['matched'] += 1
+                    doc_partition_key = partition_key
+                    if doc_partition_key is None:
+                        try:
+                            doc_partition_key = get_partition_key_value(doc, partition_key_path)
+                        except ValueError as e:
+                            fail(str(e))
+                            continue
+                    await semaphore.acquire()
+                    task = asyncio.ensure_future(delete(doc['id'], doc_partition_key))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+
+                if on_progress is not None:
+                    on_progress(dict(stats))
+
+            if pending:
+                await asyncio.gather(*pending)
+        finally:
+            for task in pending:
+                task.cancel()
+
+        if on_progress is not None:
+            on_progress(dict(stats))
+        return stats
+
+    async def get_document(self, database: str, container: str, doc_id: str, partition_key: Any,
+                           priority: str = Priority.Interactive,
+                           timeout: Optional[float] = None) -> Dict[str, Any]:
         headers = self._get_headers(http_constants.HttpMethods.Get,
                                     f'dbs/{database}/colls/{container}/docs/{doc_id}', 'docs')
-        headers[http_constants.HttpHeaders.PartitionKey] = f'["{partition_key}"]'
+        headers[http_constants.HttpHeaders.PartitionKey] = jsonlib.dumps([partition_key])
 
-        async with self.session.get(f'{self._get_writable()}/dbs/{database}/colls/{container}/docs/{doc_id}',
-                                    headers=headers) as response:
+        async with self._request(http_constants.HttpMethods.Get, f'dbs/{database}/colls/{container}/docs/{doc_id}',
+                                 f'get_document:{database}/{container}', priority, read=True, timeout=timeout,
+                                 headers=headers) as response:
             return await self._handle_response(response, f"Could not get document: {database}:{container}:{doc_id}",
                                                manage_session=True)
 
+    async def list_partition_key_ranges(self, database: str, container: str) -> Dict[str, Any]:
+        ranges = []
+        continuation = None
+        while True:
+            headers = self._get_headers(http_constants.HttpMethods.Get, f'dbs/{database}/colls/{container}',
+                                        http_constants.ResourceType.PartitionKeyRange)
+            if continuation is not None:
+                headers[http_constants.HttpHeaders.Continuation] = continuation
+
+            async with self._request(http_constants.HttpMethods.Get, f'dbs/{database}/colls/{container}/pkranges',
+                                     'list_partition_key_ranges', read=True, headers=headers) as response:
+                res = await self._handle_response(response,
+                                                  f"Could not list partition key ranges: {database}:{container}",
+                                                  subkey='PartitionKeyRanges')
+                if res['status'] == 'failed':
+                    return res
+                ranges.extend(res['data'])
+                continuation = response.headers.get(http_constants.HttpHeaders.Continuation)
+                if continuation is None:
+                    res['data'] = ranges
+                    return res
+
     async def query_documents(self,
                               database: str,
                               container: str,
                               query: str,
                               partition_key: Optional[Any] = None,
                               enable_cross_partition_query: Optional[bool] = False,
-                              session_token: Optional[str] = None) -> AsyncGenerator:
+                              session_token: Optional[str] = None,
+                              partition_key_range_id: Optional[str] = None,
+                              continuation: Optional[str] = None,
+                              max_item_count: Optional[int] = None,
+                              priority: str = Priority.Interactive,
+                              timeout: Optional[float] = None,
+                              max_concurrency: int = 10,
+                              max_distinct_values: int = 1000000,
+                              populate_query_metrics: bool = False) -> AsyncGenerator:
 
-        continuation = None
         session_token = session_token if session_token is None else self.session_token
+
+        # cross partition aggregates and DISTINCT are answered per partition key range by the gateway, so they are
+        # fanned out to every range and combined here
+        if enable_cross_partition_query and partition_key_range_id is None and continuation is None:
+            kwargs = dict(session_token=session_token, max_item_count=max_item_count, priority=priority,
+                          timeout=timeout, populate_query_metrics=populate_query_metrics)
+            aggregate = parse_aggregate_query(query)
+            if aggregate is not None:
+                yield await self._query_aggregate(database, container, aggregate, max_concurrency, **kwargs)
+                return
+            if is_distinct_query(query):
+                async for page in self._query_distinct(database, container, query, max_concurrency,
+                                                       DistinctFilter(max_distinct_values), **kwargs):
+                    yield page
+                return
+
+        total_metrics = None
         while True:
             headers = self._get_headers(http_constants.HttpMethods.Post, f'dbs/{database}/colls/{container}',
                                         'docs', is_query=True, session_token=session_token)
-            if enable_cross_partition_query:
+            if partition_key_range_id is not None:
+                headers[http_constants.HttpHeaders.EnableCrossPartitionQuery] = 'True'
+                headers[http_constants.HttpHeaders.PartitionKeyRangeID] = partition_key_range_id
+            elif enable_cross_partition_query:
                 headers[http_constants.HttpHeaders.EnableCrossPartitionQuery] = 'True'
             else:
-                headers[http_constants.HttpHeaders.PartitionKey] = f'["{partition_key}"]'
+                headers[http_constants.HttpHeaders.PartitionKey] = jsonlib.dumps([partition_key])
 
             if continuation is not None:
                 headers[http_constants.HttpHeaders.Continuation] = continuation
 
+            if max_item_count is not None:
+                headers[http_constants.HttpHeaders.PageSize] = str(max_item_count)
+
+            if populate_query_metrics:
+                headers[http_constants.HttpHeaders.PopulateQueryMetrics] = 'True'
+                headers[http_constants.HttpHeaders.PopulateIndexMetrics] = 'True'
+
             json = {
                 'query': query,
                 'parameters': []
             }
 
-            async with self.session.post(f'{self._get_writable()}/dbs/{database}/colls/{container}/docs',
-                                         headers=headers, json=json) as response:
+            async with self._request(http_constants.HttpMethods.Post, f'dbs/{database}/colls/{container}/docs',
+                                     f'query_documents:{database}/{container}:{query_shape(query)}', priority,
+                                     read=True, timeout=timeout, headers=headers, json=json) as response:
                 res = await self._handle_response(response, f"Could not query documents",
                                                   manage_session=True, subkey='Documents')
 
-                yield res
-
                 continuation = response.headers.get(http_constants.HttpHeaders.Continuation)
+                res['continuation'] = continuation
+
+                if populate_query_metrics:
+                    metrics = QueryMetrics.parse(response.headers.get(http_constants.HttpHeaders.QueryMetrics),
+                                                 response.headers.get(http_constants.HttpHeaders.RequestCharge))
+                    total_metrics = metrics if total_metrics is None else total_metrics + metrics
+                    res['query_metrics'] = metrics
+                    res['total_query_metrics'] = total_metrics
+                    res['index_metrics'] = parse_index_metrics(
+                        response.headers.get(http_constants.HttpHeaders.IndexUtilization))
+
+                yield res
 
                 session_token = response.headers.get(http_constants.HttpHeaders.SessionToken)
 
@@ -311,9 +920,123 @@ class CosmosClient:
 
 
 
+    async def _query_range(self, database: str, container: str, query: str, range_id: str,
+                           semaphore: asyncio.Semaphore, **kwargs) -> AsyncGenerator:
+        async with semaphore:
+            async for page in self.query_documents(database, container, query, partition_key_range_id=range_id,
+                                                   **kwargs):
+                yield page
+                if page['status'] == 'failed':
+                    return
+
+    async def _query_aggregate(self, database: str, container: str, aggregate: AggregateQuery,
+                               max_concurrency: int, **kwargs) -> Dict[str, Any]:
+        ranges = (await self.metadata.container(database, container))['partition_key_ranges']
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def partial(function: str, query: str, range_id: str) -> Tuple[str, Dict[str, Any]]:
+            values = []
+            async for page in self._query_range(database, container, query, range_id, semaphore, **kwargs):
+                if page['status'] == 'failed':
+                    return function, page
+                values.extend(page['data'])
+                last = page
+            return function, dict(last, data=values)
+
+        tasks = [asyncio.ensure_future(partial(function, query, r['id']))
+                 for function, query in aggregate.partition_queries() for r in ranges]
+        aggregator = Aggregator(aggregate.function)
+        session_token = None
+        total_metrics = None
+        try:
+            for next_partial in asyncio.as_completed(tasks):
+                function, page = await next_partial
+                if page['status'] == 'failed':
+                    return page
+                for value in page['data']:
+                    aggregator.add(value, function)
+                session_token = page['session_token']
+                if 'total_query_metrics' in page:
+                    metrics = page['total_query_metrics']
+                    total_metrics = metrics if total_metrics is None else total_metrics + metrics
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        res = {
+            'status': 'ok',
+            'code': http_constants.StatusCodes.OK,
+            'session_token': session_token,
+            'error': None,
+            'data': aggregate.format(aggregator.result()),
+            'continuation': None
+        }
+        if total_metrics is not None:
+            res['query_metrics'] = res['total_query_metrics'] = total_metrics
+        return res
+
+    async def _query_distinct(self, database: str, container: str, query: str, max_concurrency: int,
+                              distinct: DistinctFilter, **kwargs) -> AsyncGenerator:
+        ranges = (await self.metadata.container(database, container))['partition_key_ranges']
+        semaphore = asyncio.Semaphore(max_concurrency)
+        # bounded so a slow consumer holds back the producers instead of buffering whole ranges
+        queue = asyncio.Queue(maxsize=max_concurrency)
+        done = object()
+
+        async def produce(range_id: str):
+            try:
+                async for page in self._query_range(database, container, query, range_id, semaphore, **kwargs):
+                    await queue.put(page)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await queue.put(e)
+            await queue.put(done)
+
+        producers = [asyncio.ensure_future(produce(r['id'])) for r in ranges]
+        total_metrics = None
+        try:
+            finished = 0
+            while finished < len(producers):
+                item = await queue.get()
+                if item is done:
+                    finished += 1
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+                if item['status'] == 'failed':
+                    yield item
+                    return
+                if 'query_metrics' in item:
+                    # each range keeps its own running total, the caller wants one across every range
+                    metrics = item['query_metrics']
+                    total_metrics = metrics if total_metrics is None else total_metrics + metrics
+                    item = dict(item, total_query_metrics=total_metrics)
+                data = [value for value in item['data'] if distinct.add(value)]
+                if data or 'query_metrics' in item:
+                    yield dict(item, data=data, continuation=None)
+        finally:
+            for producer in producers:
+                producer.cancel()
+
+
 @asynccontextmanager
-async def get_client(endpoint: str, key: str, debug: bool = False, raise_on_failure: bool = False) -> CosmosClient:
-    client = CosmosClient(endpoint, key, debug, raise_on_failure)
+async def get_client(endpoint: str, key: str, debug: bool = False, raise_on_failure: bool = False,
+                     ru_limiter: Optional[RULimiter] = None,
+                     hedging: Optional[HedgingPolicy] = None,
+                     timeout: Optional[float] = None,
+                     circuit_breaker: Optional[CircuitBreakerPolicy] = None,
+                     max_retries: int = 0,
+                     metadata_ttl: Optional[float] = 300.0,
+                     offload_threshold: Optional[int] = None,
+                     offload_executor: Optional[Executor] = None,
+                     offload_workers: int = 4,
+                     no_response_on_write: bool = False) -> CosmosClient:
+    client = CosmosClient(endpoint, key, debug, raise_on_failure, ru_limiter=ru_limiter, hedging=hedging,
+                          timeout=timeout, circuit_breaker=circuit_breaker, max_retries=max_retries,
+                          metadata_ttl=metadata_ttl, offload_threshold=offload_threshold,
+                          offload_executor=offload_executor, offload_workers=offload_workers,
+                          no_response_on_write=no_response_on_write)
     await client.connect()
     try:
         yield client
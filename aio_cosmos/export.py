@@ -0,0 +1,259 @@
+"""Parallel, resumable export of a container to NDJSON files.
+
+The container is split by partition key range and each range is read as its own query stream. Every range is
+written to its own NDJSON file (optionally gzip compressed) one page at a time, and the continuation token and
+file offset for each range are saved after every page so an interrupted export can be resumed where it left off.
+"""
+
+import argparse
+import asyncio
+import gzip
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+from . import http_constants
+from .client import CosmosClient, CosmosError, get_client
+from .limiter import Priority
+
+STATE_FILE = 'export-state.json'
+
+
+class RangeSplitError(Exception):
+
+    def __init__(self, range_id: str):
+        self.range_id = range_id
+        super().__init__(f'Partition key range {range_id} has been split')
+
+
+class ContainerExport:
+
+    def __init__(self, client: CosmosClient,
+                 database: str,
+                 container: str,
+                 directory: str,
+                 query: str = 'select * from c',
+                 compress: bool = False,
+                 max_concurrency: int = 8,
+                 max_item_count: Optional[int] = None,
+                 max_gone_retries: int = 5):
+        self.client = client
+        self.database = database
+        self.container = container
+        self.directory = directory
+        self.query = query
+        self.compress = compress
+        self.max_concurrency = max_concurrency
+        self.max_item_count = max_item_count
+        self.max_gone_retries = max_gone_retries
+        self.state_path = os.path.join(directory, STATE_FILE)
+        self.state = None
+
+    def _file_name(self, range_id: str) -> str:
+        return f'{self.container}-range-{range_id}.ndjson' + ('.gz' if self.compress else '')
+
+    def _new_range_state(self, range_id: str, continuation: Optional[str] = None) -> Dict[str, Any]:
+        return {
+            'file': self._file_name(range_id),
+            'continuation': continuation,
+            'offset': 0,
+            'documents': 0,
+            'done': False
+        }
+
+    def _load_state(self) -> Dict[str, Any]:
+        if not os.path.exists(self.state_path):
+            return {
+                'database': self.database,
+                'container': self.container,
+                'query': self.query,
+                'compress': self.compress,
+                'ranges': {}
+            }
+
+        with open(self.state_path, 'r') as f:
+            state = json.load(f)
+
+        for key in ('database', 'container', 'query', 'compress'):
+            if state[key] != getattr(self, key):
+                raise ValueError(f'Existing export state in {self.directory} was created with a different {key}: '
+                                 f'{state[key]!r}')
+        return state
+
+    def _save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    async def _resolve_ranges(self) -> int:
+        res = await self.client.list_partition_key_ranges(self.database, self.container)
+        if res['status'] == 'failed':
+            raise CosmosError(res['code'], res['data'], res['error'])
+
+        current = {r['id']: r for r in res['data']}
+        ranges = self.state['ranges']
+
+        # A range that no longer exists has been split; its children pick up from the parent's continuation so
+        # documents already written by the parent are not exported twice. The parent is kept, as done, so its file
+        # and document count are still reported.
+        split = [r for r in ranges if r not in current and not ranges[r]['done']]
+        for range_id in split:
+            parent = ranges[range_id]
+            children = [r for r in current.values() if range_id in r.get('parents', [])]
+            if not children:
+                raise CosmosError(http_constants.StatusCodes.GONE, {},
+                                  f'Could not find the children of split partition key range {range_id}')
+            for child in children:
+                ranges[child['id']] = self._new_range_state(child['id'], parent['continuation'])
+                ranges[child['id']]['split_from'] = range_id
+            parent['done'] = True
+            parent['split'] = True
+
+        # ranges descended from one that has already been fully exported need no further work
+        for range_id, pk_range in current.items():
+            if range_id not in ranges and not any(p in ranges for p in pk_range.get('parents', [])):
+                ranges[range_id] = self._new_range_state(range_id)
+
+        self._save_state()
+        return len(split)
+
+    @staticmethod
+    def _open(path: str, offset: int):
+        handle = open(path, 'r+b' if os.path.exists(path) else 'wb')
+        # anything past the last saved offset belongs to a page whose continuation was never recorded
+        handle.truncate(offset)
+        handle.seek(offset)
+        return handle
+
+    def _write_page(self, handle, documents: List[Dict[str, Any]]) -> int:
+        data = b''.join(json.dumps(doc, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+                        for doc in documents)
+        if self.compress:
+            # each page is a complete gzip member so the saved offset is always a valid resume point
+            data = gzip.compress(data)
+        handle.write(data)
+        handle.flush()
+        os.fsync(handle.fileno())
+        return handle.tell()
+
+    async def _export_range(self, range_id: str, semaphore: asyncio.Semaphore):
+        loop = asyncio.get_event_loop()
+        range_state = self.state['ranges'][range_id]
+
+        async with semaphore:
+            path = os.path.join(self.directory, range_state['file'])
+            handle = await loop.run_in_executor(None, self._open, path, range_state['offset'])
+            try:
+                pages = self.client.query_documents(self.database, self.container, self.query,
+                                                    partition_key_range_id=range_id,
+                                                    continuation=range_state['continuation'],
+                                                    max_item_count=self.max_item_count,
+                                                    priority=Priority.Background)
+                try:
+                    async for page in pages:
+                        if page['status'] == 'failed':
+                            raise CosmosError(page['code'], page['data'], page['error'])
+
+                        offset = await loop.run_in_executor(None, self._write_page, handle, page['data'])
+
+                        range_state['offset'] = offset
+                        range_state['documents'] += len(page['data'])
+                        range_state['continuation'] = page['continuation']
+                        range_state['done'] = page['continuation'] is None
+                        self._save_state()
+                except CosmosError as e:
+                    if e.http_status_code == http_constants.StatusCodes.GONE:
+                        raise RangeSplitError(range_id) from e
+                    raise
+                finally:
+                    await pages.aclose()
+            finally:
+                await loop.run_in_executor(None, handle.close)
+
+    async def run(self) -> Dict[str, Any]:
+        os.makedirs(self.directory, exist_ok=True)
+        self.state = self._load_state()
+        await self._resolve_ranges()
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        attempt = 0
+        while True:
+            pending = [r for r, s in self.state['ranges'].items() if not s['done']]
+            if not pending:
+                break
+
+            results = await asyncio.gather(*[self._export_range(r, semaphore) for r in pending],
+                                           return_exceptions=True)
+            errors = [r for r in results if isinstance(r, BaseException) and not isinstance(r, RangeSplitError)]
+            if errors:
+                raise errors[0]
+
+            # a range returned 410, re-read the topology and continue with the children of any that split
+            if not any(isinstance(r, RangeSplitError) for r in results):
+                continue
+            if await self._resolve_ranges():
+                attempt = 0
+                continue
+
+            # the range still exists, so the 410 was transient, e.g. a split still completing
+            if attempt >= self.max_gone_retries:
+                raise next(r for r in results if isinstance(r, RangeSplitError))
+            await asyncio.sleep(min(0.5 * 2 ** attempt, 10.0))
+            attempt += 1
+
+        ranges = self.state['ranges']
+        return {
+            'status': 'ok',
+            'ranges': len(ranges),
+            'documents': sum(r['documents'] for r in ranges.values()),
+            'files': [os.path.join(self.directory, r['file']) for r in ranges.values()]
+        }
+
+
+async def export_container(client: CosmosClient,
+                           database: str,
+                           container: str,
+                           directory: str,
+                           query: str = 'select * from c',
+                           compress: bool = False,
+                           max_concurrency: int = 8,
+                           max_item_count: Optional[int] = None,
+                           max_gone_retries: int = 5) -> Dict[str, Any]:
+    export = ContainerExport(client, database, container, directory, query=query, compress=compress,
+                             max_concurrency=max_concurrency, max_item_count=max_item_count,
+                             max_gone_retries=max_gone_retries)
+    return await export.run()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog='aio-cosmos-export',
+                                     description='Export a Cosmos DB container to NDJSON files, one per '
+                                                 'partition key range. Re-running with the same output '
+                                                 'directory resumes an interrupted export.')
+    parser.add_argument('database')
+    parser.add_argument('container')
+    parser.add_argument('directory')
+    parser.add_argument('--endpoint', default=os.getenv('ENDPOINT'))
+    parser.add_argument('--key', default=os.getenv('MASTER_KEY'))
+    parser.add_argument('--query', default='select * from c')
+    parser.add_argument('--gzip', action='store_true', help='gzip compress the output files')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of ranges to read in parallel')
+    parser.add_argument('--page-size', type=int, default=None, help='maximum documents per page')
+    args = parser.parse_args(argv)
+
+    if not args.endpoint or not args.key:
+        parser.error('an endpoint and key are required, either as arguments or ENDPOINT and MASTER_KEY')
+
+    async def run():
+        async with get_client(args.endpoint, args.key, raise_on_failure=True) as client:
+            return await export_container(client, args.database, args.container, args.directory,
+                                          query=args.query, compress=args.gzip,
+                                          max_concurrency=args.concurrency, max_item_count=args.page_size)
+
+    result = asyncio.run(run())
+    print(f"exported {result['documents']} documents from {result['ranges']} ranges to {args.directory}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Hedged reads to cut tail latency.
+
+When a read has not returned within an adaptive threshold (by default the observed p95 latency of that operation)
+a duplicate request is sent to the next readable endpoint. The first usable response wins and the others are
+cancelled.
+"""
+
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict
+
+from aiohttp.client_reqrep import ClientResponse
+
+from . import http_constants
+
+
+class HedgingPolicy:
+
+    def __init__(self, percentile: float = 0.95,
+                 max_hedges: int = 1,
+                 max_hedge_ratio: float = 0.1,
+                 initial_threshold: float = 0.1,
+                 min_threshold: float = 0.005,
+                 min_samples: int = 20,
+                 window: int = 500,
+                 max_operations: int = 1000):
+        """
+        :param percentile: the latency percentile of an operation after which a hedge is sent
+        :param max_hedges: the maximum number of duplicate requests sent for a single read
+        :param max_hedge_ratio: the maximum fraction of reads that may be hedged, so a region wide slowdown does
+            not double the load on the account
+        :param initial_threshold: the threshold in seconds used until ``min_samples`` latencies have been observed
+        :param min_threshold: the lower bound in seconds for the threshold
+        :param window: the number of recent latencies kept per operation
+        :param max_operations: the number of operations tracked, the least recently recorded are dropped
+        """
+        self.percentile = percentile
+        self.max_hedges = max_hedges
+        self.max_hedge_ratio = max_hedge_ratio
+        self.initial_threshold = initial_threshold
+        self.min_threshold = min_threshold
+        self.min_samples = min_samples
+        self.window = window
+        self.max_operations = max_operations
+
+        self.latencies: Dict[str, Deque[float]] = OrderedDict()
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.capped = 0
+
+    def threshold(self, operation: str) -> float:
+        samples = self.latencies.get(operation)
+        if samples is None or len(samples) < self.min_samples:
+            return self.initial_threshold
+        ordered = sorted(samples)
+        index = min(int(len(ordered) * self.percentile), len(ordered) - 1)
+        return max(ordered[index], self.min_threshold)
+
+    def record(self, operation: str, latency: float):
+        if operation not in self.latencies:
+            self.latencies[operation] = deque(maxlen=self.window)
+            if len(self.latencies) > self.max_operations:
+                self.latencies.popitem(last=False)
+        self.latencies.move_to_end(operation)
+        self.latencies[operation].append(latency)
+
+    def allow_hedge(self) -> bool:
+        if self.hedges >= self.max_hedge_ratio * self.requests + 1:
+            self.capped += 1
+            return False
+        return True
+
+    @staticmethod
+    def acceptable(response: ClientResponse) -> bool:
+        """Whether a response can win the race, errors caused by the endpoint itself defer to the other requests.
+        """
+        if response.status >= http_constants.StatusCodes.INTERNAL_SERVER_ERROR or response.status in (
+                http_constants.StatusCodes.REQUEST_TIMEOUT, http_constants.StatusCodes.TOO_MANY_REQUESTS):
+            return False
+        substatus = response.headers.get(http_constants.HttpHeaders.SubStatus)
+        return not (response.status == http_constants.StatusCodes.NOT_FOUND and substatus is not None
+                    and int(substatus) == http_constants.SubStatusCodes.READ_SESSION_NOTAVAILABLE)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'requests': self.requests,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'capped': self.capped,
+            'thresholds': {op: self.threshold(op) for op in self.latencies}
+        }
@@ -92,6 +92,8 @@ class HttpHeaders(object):
     IsQueryPlanRequest = "x-ms-cosmos-is-query-plan-request"
     SupportedQueryFeatures = "x-ms-cosmos-supported-query-features"
     QueryVersion = "x-ms-cosmos-query-version"
+    QueryMetrics = "x-ms-documentdb-query-metrics"
+    IndexUtilization = "x-ms-cosmos-index-utilization"
 
     # Our custom DocDB headers
     Continuation = "x-ms-continuation"
@@ -118,6 +120,7 @@ class HttpHeaders(object):
     AlternateContentPath = "x-ms-alt-content-path"
     IsContinuationExpected = "x-ms-documentdb-query-iscontinuationexpected"
     PopulateQueryMetrics = "x-ms-documentdb-populatequerymetrics"
+    PopulateIndexMetrics = "x-ms-cosmos-populateindexmetrics"
 
     # Quota Info
     MaxEntityCount = "x-ms-root-entity-max-count"
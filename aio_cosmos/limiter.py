@@ -0,0 +1,206 @@
+"""Client-wide request unit (RU) budget limiter.
+
+A token bucket measured in RU/s shared by every request made through a CosmosClient. The cost of each operation is
+not known until the response arrives, so the limiter admits requests against a learned estimate per operation and
+settles the difference once the x-ms-request-charge header has been read.
+"""
+
+import asyncio
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+
+class Priority(object):
+    """Priority classes for admission to the RU budget.
+    """
+
+    Interactive = "interactive"
+    Background = "background"
+
+
+PRIORITY_ORDER = (Priority.Interactive, Priority.Background)
+
+
+class RULimiter:
+
+    def __init__(self, ru_per_second: float,
+                 burst: Optional[float] = None,
+                 background_reserve: float = 0.2,
+                 default_cost: float = 5.0,
+                 smoothing: float = 0.2,
+                 max_operations: int = 1000):
+        """
+        :param ru_per_second: the sustained budget in RU/s
+        :param burst: bucket capacity in RU, defaults to one second of budget
+        :param background_reserve: fraction of the bucket background requests may not draw down, leaving
+            headroom for interactive requests when the budget is tight
+        :param default_cost: estimated RU charge for an operation that has not been seen before
+        :param smoothing: weight given to the latest observed charge in the per operation moving average
+        :param max_operations: the number of operation estimates kept, the least recently charged are dropped
+        """
+        if ru_per_second <= 0:
+            raise ValueError('ru_per_second must be greater than zero')
+
+        self.rate = float(ru_per_second)
+        self.capacity = float(burst) if burst is not None else self.rate
+        self.reserve = self.capacity * background_reserve
+        self.default_cost = default_cost
+        self.smoothing = smoothing
+        self.tokens = self.capacity
+        self.max_operations = max_operations
+        self.estimates: Dict[str, float] = OrderedDict()
+
+        self._updated = None
+        self._queues: Dict[str, Deque[Tuple[float, float, asyncio.Future]]] = {p: deque() for p in PRIORITY_ORDER}
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._stats = {p: {'admitted': 0, 'waited': 0, 'total_wait': 0.0, 'max_wait': 0.0} for p in PRIORITY_ORDER}
+        self._charged = 0.0
+
+    def _now(self) -> float:
+        return asyncio.get_event_loop().time()
+
+    def _refill(self):
+        now = self._now()
+        if self._updated is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def estimate(self, operation: str) -> float:
+        return self.estimates.get(operation, self.default_cost)
+
+    def _can_admit(self, priority: str, cost: float) -> bool:
+        # costs larger than the bucket are admitted once it is full and leave the bucket in debt
+        needed = min(cost, self.capacity)
+        if priority == Priority.Background:
+            if self._queues[Priority.Interactive]:
+                return False
+            return self.tokens - needed >= self.reserve or self.tokens >= self.capacity
+        return self.tokens >= needed
+
+    def _admit(self, priority: str, cost: float, wait: float):
+        self.tokens -= cost
+        stats = self._stats[priority]
+        stats['admitted'] += 1
+        if wait > 0:
+            stats['waited'] += 1
+            stats['total_wait'] += wait
+            stats['max_wait'] = max(stats['max_wait'], wait)
+
+    async def acquire(self, operation: str, priority: str = Priority.Interactive) -> float:
+        """Wait until the estimated cost of ``operation`` fits within the budget.
+
+        :return: the estimated cost that was charged, to be passed back to :meth:`record`
+        """
+        if priority not in self._queues:
+            raise ValueError(f'Unknown priority: {priority}')
+
+        cost = self.estimate(operation)
+        self._refill()
+
+        if not any(self._queues[p] for p in PRIORITY_ORDER[:PRIORITY_ORDER.index(priority) + 1]) \
+                and self._can_admit(priority, cost):
+            self._admit(priority, cost, 0.0)
+            return cost
+
+        waiter = asyncio.get_event_loop().create_future()
+        entry = (cost, self._now(), waiter)
+        self._queues[priority].append(entry)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if not waiter.done() or waiter.cancelled():
+                try:
+                    self._queues[priority].remove(entry)
+                except ValueError:
+                    pass
+            else:
+                # admitted just as the caller was cancelled, hand the estimate back
+                self.release(cost)
+            raise
+        return cost
+
+    def take(self, operation: str) -> float:
+        """Charge the estimated cost of ``operation`` without waiting, for hedged requests that cannot be delayed.
+
+        :return: the estimated cost that was charged, to be passed back to :meth:`record`
+        """
+        cost = self.estimate(operation)
+        self._refill()
+        self.tokens -= cost
+        return cost
+
+    def release(self, estimated: float):
+        """Return the estimate of an admitted request that was never sent or never completed.
+        """
+        self.tokens = min(self.capacity, self.tokens + estimated)
+
+    async def _dispatch(self):
+        while any(self._queues.values()):
+            self._refill()
+            admitted = False
+            for priority in PRIORITY_ORDER:
+                queue = self._queues[priority]
+                while queue and queue[0][2].done():
+                    queue.popleft()
+                if not queue:
+                    continue
+                cost, enqueued, waiter = queue[0]
+                if self._can_admit(priority, cost):
+                    queue.popleft()
+                    self._admit(priority, cost, self._now() - enqueued)
+                    waiter.set_result(None)
+                    admitted = True
+                break
+
+            if not admitted:
+                await asyncio.sleep(self._delay())
+
+    def _delay(self) -> float:
+        for priority in PRIORITY_ORDER:
+            queue = self._queues[priority]
+            if queue:
+                needed = min(queue[0][0], self.capacity)
+                if priority == Priority.Background:
+                    needed = min(needed + self.reserve, self.capacity)
+                return max((needed - self.tokens) / self.rate, 0.001)
+        return 0.001
+
+    def record(self, operation: str, estimated: float, charge: Optional[float],
+               retry_after_ms: Optional[float] = None):
+        """Settle an admitted request against its actual charge and update the estimate for ``operation``.
+
+        :param retry_after_ms: the server requested back-off when the request was throttled, during which no
+            further requests are admitted
+        """
+        if charge is not None:
+            self.tokens += estimated - charge
+            self._charged += charge
+            previous = self.estimates.get(operation)
+            self.estimates[operation] = charge if previous is None \
+                else self.smoothing * charge + (1 - self.smoothing) * previous
+            self.estimates.move_to_end(operation)
+            if len(self.estimates) > self.max_operations:
+                self.estimates.popitem(last=False)
+
+        if retry_after_ms is not None:
+            self._refill()
+            self.tokens = min(self.tokens, -self.rate * retry_after_ms / 1000)
+
+    def stats(self) -> Dict[str, Any]:
+        self._refill()
+        return {
+            'tokens': self.tokens,
+            'ru_charged': self._charged,
+            'queue_depth': {p: len(q) for p, q in self._queues.items()},
+            'priorities': {
+                p: {
+                    'admitted': s['admitted'],
+                    'waited': s['waited'],
+                    'mean_wait': s['total_wait'] / s['waited'] if s['waited'] else 0.0,
+                    'max_wait': s['max_wait'],
+                } for p, s in self._stats.items()
+            }
+        }
@@ -0,0 +1,174 @@
+"""Account and container metadata cache.
+
+Entries are served from memory and refreshed in the background once they are older than the TTL, so operations
+only wait on a metadata round trip the first time an entry is needed. The account topology is also refreshed on a
+timer and whenever a response indicates the client's view of the account or a container is stale.
+"""
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from . import http_constants
+
+
+def get_partition_key_value(document: Dict[str, Any], path: str) -> Any:
+    """Read the partition key value from a document given a partition key path such as ``/account/id``.
+    """
+    value = document
+    for part in path.strip('/').split('/'):
+        part = part.strip('"')
+        if not isinstance(value, dict) or part not in value:
+            raise ValueError(f'Document {document.get("id")} has no value for partition key path {path}')
+        value = value[part]
+    return value
+
+
+class MetadataCache:
+
+    def __init__(self, client, ttl: Optional[float] = 300.0):
+        """
+        :param client: the CosmosClient used to load metadata
+        :param ttl: seconds after which an entry is refreshed in the background, None to never refresh
+        """
+        self.client = client
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+        self._entries: Dict[Tuple, Tuple[Any, float]] = {}
+        self._loading: Dict[Tuple, asyncio.Task] = {}
+        self._refresher: Optional[asyncio.Task] = None
+
+    async def _get(self, key: Tuple, loader: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            value, fetched = entry
+            if self.ttl is not None and time.monotonic() - fetched > self.ttl:
+                self._load(key, loader)
+            return value
+
+        self.misses += 1
+        # shielded so a cancelled caller does not cancel a load other callers are waiting on
+        return await asyncio.shield(self._load(key, loader))
+
+    def _load(self, key: Tuple, loader: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        task = self._loading.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, loader))
+            # background refreshes have nobody awaiting them, a failure keeps serving the previous value
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._loading[key] = task
+        return task
+
+    async def _fetch(self, key: Tuple, loader: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            value = await loader()
+            if key in self._entries:
+                self.refreshes += 1
+            self._entries[key] = (value, time.monotonic())
+            return value
+        finally:
+            self._loading.pop(key, None)
+
+    @staticmethod
+    def _check(res: Dict[str, Any]) -> Any:
+        if res['status'] == 'failed':
+            from .client import CosmosError
+            raise CosmosError(res['code'], res['data'], res['error'])
+        return res['data']
+
+    async def _load_account(self) -> Dict[str, Any]:
+        account = self._check(await self.client.get_database_account())
+        self.client.server_details = account
+        self.client.writable_endpoints = account['writableLocations']
+        self.client.readable_endpoints = account['readableLocations']
+        return account
+
+    async def _load_container(self, database: str, container: str) -> Dict[str, Any]:
+        properties, ranges = await asyncio.gather(self.client.get_container(database, container),
+                                                  self.client.list_partition_key_ranges(database, container))
+        properties = self._check(properties)
+        return {
+            'properties': properties,
+            'partition_key_paths': properties['partitionKey']['paths'],
+            'indexing_policy': properties.get('indexingPolicy'),
+            'partition_key_ranges': self._check(ranges)
+        }
+
+    async def account(self) -> Dict[str, Any]:
+        return await self._get(('account',), self._load_account)
+
+    async def databases(self) -> List[Dict[str, Any]]:
+        return await self._get(('databases',), self._databases)
+
+    async def _databases(self) -> List[Dict[str, Any]]:
+        return self._check(await self.client.list_databases())['Databases']
+
+    async def container(self, database: str, container: str) -> Dict[str, Any]:
+        return await self._get(('container', database, container),
+                               lambda: self._load_container(database, container))
+
+    async def partition_key_path(self, database: str, container: str) -> str:
+        return (await self.container(database, container))['partition_key_paths'][0]
+
+    async def refresh_account(self) -> Dict[str, Any]:
+        return await self._load(('account',), self._load_account)
+
+    def invalidate(self, *key):
+        """Refresh an entry in the background, the current value is served until the refresh completes.
+        """
+        if key == ('account',):
+            self._load(key, self._load_account)
+        elif key == ('databases',):
+            self._load(key, self._databases)
+        elif key and key[0] == 'container' and key in self._entries:
+            self._load(key, lambda: self._load_container(key[1], key[2]))
+
+    def on_response(self, path: str, status: int, substatus: Optional[int]):
+        if status == http_constants.StatusCodes.FORBIDDEN \
+                and substatus == http_constants.SubStatusCodes.WRITE_FORBIDDEN:
+            # the write region has moved
+            self.invalidate('account')
+        elif status == http_constants.StatusCodes.GONE or (
+                status == http_constants.StatusCodes.NOT_FOUND
+                and substatus == http_constants.SubStatusCodes.OWNER_RESOURCE_NOT_FOUND):
+            # the container was recreated or its partition key ranges have split
+            parts = path.split('/')
+            if len(parts) >= 4 and parts[0] == 'dbs' and parts[2] == 'colls':
+                self.invalidate('container', parts[1], parts[3])
+
+    async def _refresh_periodically(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            try:
+                await self.refresh_account()
+            except Exception:
+                # keep the last known topology and try again on the next interval
+                pass
+
+    def start(self):
+        if self.ttl is not None and self._refresher is None:
+            self._refresher = asyncio.ensure_future(self._refresh_periodically())
+
+    async def stop(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            try:
+                await self._refresher
+            except asyncio.CancelledError:
+                pass
+            self._refresher = None
+
+        for task in list(self._loading.values()):
+            task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'entries': len(self._entries)
+        }
@@ -0,0 +1,81 @@
+"""Query execution and index utilization metrics.
+
+When requested, the gateway returns execution metrics for each query page in the x-ms-documentdb-query-metrics
+header as ``key=value`` pairs separated by semicolons, and index utilization in the x-ms-cosmos-index-utilization
+header as base64 encoded JSON.
+"""
+
+import base64
+import json
+from typing import Any, Dict, Optional
+
+# header key -> attribute name
+_FIELDS = {
+    'retrievedDocumentCount': 'retrieved_document_count',
+    'retrievedDocumentSize': 'retrieved_document_size',
+    'outputDocumentCount': 'output_document_count',
+    'outputDocumentSize': 'output_document_size',
+    'totalExecutionTimeInMs': 'total_execution_time_ms',
+    'queryCompileTimeInMs': 'query_compile_time_ms',
+    'queryLogicalPlanBuildTimeInMs': 'logical_plan_build_time_ms',
+    'queryPhysicalPlanBuildTimeInMs': 'physical_plan_build_time_ms',
+    'queryOptimizationTimeInMs': 'query_optimization_time_ms',
+    'VMExecutionTimeInMs': 'vm_execution_time_ms',
+    'indexLookupTimeInMs': 'index_lookup_time_ms',
+    'documentLoadTimeInMs': 'document_load_time_ms',
+    'systemFunctionExecuteTimeInMs': 'system_function_execute_time_ms',
+    'userFunctionExecuteTimeInMs': 'user_function_execute_time_ms',
+    'writeOutputTimeInMs': 'document_write_time_ms',
+}
+
+
+class QueryMetrics:
+
+    def __init__(self, request_charge: float = 0.0, index_hit_ratio: float = 0.0, **fields):
+        self.request_charge = request_charge
+        self.index_hit_ratio = index_hit_ratio
+        for name in _FIELDS.values():
+            setattr(self, name, fields.get(name, 0))
+
+    @classmethod
+    def parse(cls, header: Optional[str], request_charge: Optional[str] = None) -> 'QueryMetrics':
+        fields = {}
+        index_hit_ratio = 0.0
+        for pair in (header or '').split(';'):
+            key, _, value = pair.partition('=')
+            key = key.strip()
+            if key == 'indexUtilizationRatio':
+                index_hit_ratio = float(value)
+            elif key in _FIELDS:
+                name = _FIELDS[key]
+                fields[name] = int(value) if name.endswith(('_count', '_size')) else float(value)
+        return cls(request_charge=float(request_charge) if request_charge else 0.0,
+                   index_hit_ratio=index_hit_ratio, **fields)
+
+    def __add__(self, other: 'QueryMetrics') -> 'QueryMetrics':
+        retrieved = self.retrieved_document_count + other.retrieved_document_count
+        # the hit ratio is a per document figure, so it is combined weighted by the documents each page retrieved
+        ratio = (self.index_hit_ratio * self.retrieved_document_count +
+                 other.index_hit_ratio * other.retrieved_document_count) / retrieved if retrieved else 0.0
+        return QueryMetrics(request_charge=self.request_charge + other.request_charge, index_hit_ratio=ratio,
+                            **{name: getattr(self, name) + getattr(other, name) for name in _FIELDS.values()})
+
+    def to_dict(self) -> Dict[str, Any]:
+        result = {name: getattr(self, name) for name in _FIELDS.values()}
+        result['index_hit_ratio'] = self.index_hit_ratio
+        result['request_charge'] = self.request_charge
+        return result
+
+    def __repr__(self) -> str:
+        return (f'QueryMetrics(request_charge={self.request_charge}, '
+                f'retrieved_document_count={self.retrieved_document_count}, '
+                f'output_document_count={self.output_document_count}, index_hit_ratio={self.index_hit_ratio}, '
+                f'total_execution_time_ms={self.total_execution_time_ms})')
+
+
+def parse_index_metrics(header: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Decode the index utilization header into the utilized and potential single and composite indexes.
+    """
+    if not header:
+        return None
+    return json.loads(base64.b64decode(header).decode('utf-8'))
@@ -0,0 +1,164 @@
+"""Background coalescing of single document writes.
+
+Writes submitted one at a time are held for at most ``max_delay`` seconds, or until ``max_batch`` writes for the
+same container have accumulated, and are then sent together through ``create_documents`` so the group shares a single
+header build and signature and its requests go out concurrently. Every caller gets a future that resolves with the
+result, or the error, of its own write.
+"""
+
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+from .limiter import Priority
+from .metadata import get_partition_key_value
+
+
+class WriteCoalescer:
+
+    def __init__(self, client,
+                 max_batch: int = 50,
+                 max_delay: float = 0.005,
+                 max_concurrent_flushes: int = 10,
+                 max_queued_batches: int = 100,
+                 priority: str = Priority.Interactive):
+        """
+        :param client: the CosmosClient writes are sent through
+        :param max_batch: writes for one container that trigger an immediate flush
+        :param max_delay: the longest a write waits for others to join its batch, in seconds
+        :param max_concurrent_flushes: batches in flight at once, further batches wait for one to finish
+        :param max_queued_batches: batches in flight or waiting to be sent before :meth:`submit` refuses writes
+            and :meth:`write` waits
+        """
+        self.client = client
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_queued_batches = max_queued_batches
+        self.priority = priority
+        self.batches = 0
+        self.writes = 0
+
+        self._pending: Dict[Tuple, List[Tuple[Dict[str, Any], Any, asyncio.Future]]] = {}
+        self._timers: Dict[Tuple, asyncio.TimerHandle] = {}
+        self._flushes = set()
+        self._semaphore = asyncio.Semaphore(max_concurrent_flushes)
+        self._room = asyncio.Event()
+        self._closed = False
+
+    def submit(self, database: str, container: str, document: Dict[str, Any], partition_key: Any = None,
+               upsert: Optional[bool] = None, indexed: Optional[bool] = None,
+               no_response: Optional[bool] = None) -> asyncio.Future:
+        """Queue a document write, the partition key is read from the document when not given.
+
+        Raises asyncio.QueueFull while max_queued_batches batches are waiting to be sent.
+        """
+        if self._closed:
+            raise RuntimeError('WriteCoalescer is closed')
+        if len(self._flushes) >= self.max_queued_batches:
+            raise asyncio.QueueFull(f'{len(self._flushes)} write batches are already queued')
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        key = (database, container, upsert, indexed, no_response)
+        batch = self._pending.setdefault(key, [])
+        batch.append((document, partition_key, future))
+        self.writes += 1
+
+        if len(batch) >= self.max_batch:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = loop.call_later(self.max_delay, self._flush, key)
+        return future
+
+    async def write(self, database: str, container: str, document: Dict[str, Any], partition_key: Any = None,
+                    upsert: Optional[bool] = None, indexed: Optional[bool] = None,
+                    no_response: Optional[bool] = None) -> Dict[str, Any]:
+        """Queue a document write once there is room for it and wait for its result.
+        """
+        while len(self._flushes) >= self.max_queued_batches:
+            self._room.clear()
+            await self._room.wait()
+        return await self.submit(database, container, document, partition_key=partition_key, upsert=upsert,
+                                 indexed=indexed, no_response=no_response)
+
+    def _done(self, task: asyncio.Task):
+        self._flushes.discard(task)
+        self._room.set()
+
+    def _flush(self, key: Tuple):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+        # callers that gave up before the batch was sent are dropped from it
+        batch = [item for item in self._pending.pop(key, []) if not item[2].done()]
+        if not batch:
+            return
+
+        task = asyncio.ensure_future(self._write(key, batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._done)
+
+    async def _write(self, key: Tuple, batch: List[Tuple[Dict[str, Any], Any, asyncio.Future]]):
+        database, container, upsert, indexed, no_response = key
+        try:
+            async with self._semaphore:
+                path = None
+                if any(partition_key is None for _, partition_key, _ in batch):
+                    path = await self.client.metadata.partition_key_path(database, container)
+
+                documents, futures = [], []
+                for document, partition_key, future in batch:
+                    if partition_key is None:
+                        try:
+                            partition_key = get_partition_key_value(document, path)
+                        except ValueError as e:
+                            future.set_exception(e)
+                            continue
+                    documents.append((document, partition_key))
+                    futures.append(future)
+
+                if not documents:
+                    return
+                self.batches += 1
+                results = await self.client.create_documents(database, container, documents, upsert=upsert,
+                                                             indexed=indexed, priority=self.priority,
+                                                             return_exceptions=True, no_response=no_response,
+                                                             manage_session=True)
+        except asyncio.CancelledError:
+            for _, _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            # the batch as a whole failed, e.g. the container metadata could not be read
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, result in zip(futures, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def flush(self):
+        """Send every pending write now and wait for all batches in flight.
+        """
+        for key in list(self._pending):
+            self._flush(key)
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    async def close(self):
+        self._closed = True
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'writes': self.writes,
+            'batches': self.batches,
+            'pending': sum(len(b) for b in self._pending.values()),
+            'in_flight': len(self._flushes)
+        }
@@ -0,0 +1,141 @@
+"""Event loop lag under mixed load, with and without offloading large response decoding.
+
+A local gateway stand-in is started in a separate process serving multi-MB query pages and small point reads. The
+client runs a mix of concurrent large queries and small reads while a monitor task measures how late the event loop
+wakes it up, which is the delay every other coroutine on the loop sees.
+
+    python -m benchmarks.loop_lag [--uvloop] [--duration 10] [--page-mb 4]
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import socket
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from aiohttp import web
+
+from aio_cosmos.client import CosmosClient, use_uvloop
+
+KEY = base64.b64encode(b'benchmark-key').decode()
+
+
+def serve(port: int, page_mb: float):
+    doc = {'id': 'x' * 36, 'account': 'Account-1', 'description': 'benchmark document', 'values': list(range(50))}
+    doc_size = len(json.dumps(doc))
+    page = json.dumps({'Documents': [doc] * int(page_mb * 1024 * 1024 / doc_size)}).encode()
+    small = json.dumps(doc).encode()
+
+    async def account(request):
+        endpoint = f'http://127.0.0.1:{port}/'
+        return web.json_response({'writableLocations': [{'databaseAccountEndpoint': endpoint}],
+                                  'readableLocations': [{'databaseAccountEndpoint': endpoint}]})
+
+    async def query(request):
+        return web.Response(body=page, content_type='application/json')
+
+    async def get_doc(request):
+        return web.Response(body=small, content_type='application/json')
+
+    app = web.Application()
+    app.router.add_get('/', account)
+    app.router.add_post('/dbs/db/colls/coll/docs', query)
+    app.router.add_get('/dbs/db/colls/coll/docs/{doc_id}', get_doc)
+    web.run_app(app, host='127.0.0.1', port=port, print=None)
+
+
+async def monitor(lags: list, stop: asyncio.Event, interval: float = 0.001):
+    loop = asyncio.get_event_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - start - interval)
+
+
+async def run(port: int, duration: float, offload: str) -> dict:
+    kwargs = {}
+    if offload == 'thread':
+        kwargs = {'offload_threshold': 256 * 1024, 'offload_executor': ThreadPoolExecutor(max_workers=4)}
+    elif offload == 'process':
+        kwargs = {'offload_threshold': 256 * 1024, 'offload_executor': ProcessPoolExecutor(max_workers=4)}
+
+    client = CosmosClient(f'http://127.0.0.1:{port}/', KEY, metadata_ttl=None, **kwargs)
+    await client.connect()
+
+    lags, reads, pages = [], [], 0
+    stop = asyncio.Event()
+    loop = asyncio.get_event_loop()
+
+    async def query_worker():
+        nonlocal pages
+        while not stop.is_set():
+            async for _ in client.query_documents('db', 'coll', 'select * from c', enable_cross_partition_query=True):
+                pages += 1
+
+    async def read_worker():
+        while not stop.is_set():
+            start = loop.time()
+            await client.get_document('db', 'coll', 'doc', partition_key='Account-1')
+            reads.append(loop.time() - start)
+
+    tasks = [asyncio.ensure_future(monitor(lags, stop))]
+    tasks += [asyncio.ensure_future(query_worker()) for _ in range(4)]
+    tasks += [asyncio.ensure_future(read_worker()) for _ in range(8)]
+    await asyncio.sleep(duration)
+    stop.set()
+    await asyncio.gather(*tasks)
+    await client.close()
+    if 'offload_executor' in kwargs:
+        kwargs['offload_executor'].shutdown()
+
+    def percentile(values, p):
+        ordered = sorted(values)
+        return ordered[min(int(len(ordered) * p), len(ordered) - 1)] * 1000
+
+    return {
+        'pages': pages,
+        'reads': len(reads),
+        'lag_p50_ms': percentile(lags, 0.5),
+        'lag_p99_ms': percentile(lags, 0.99),
+        'lag_max_ms': max(lags) * 1000,
+        'read_p50_ms': percentile(reads, 0.5),
+        'read_p99_ms': percentile(reads, 0.99),
+        'read_mean_ms': statistics.mean(reads) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--page-mb', type=float, default=4)
+    parser.add_argument('--uvloop', action='store_true')
+    args = parser.parse_args()
+
+    if args.uvloop:
+        use_uvloop()
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    server = multiprocessing.Process(target=serve, args=(port, args.page_mb), daemon=True)
+    server.start()
+    time.sleep(1)
+
+    try:
+        print(f"{'offload':<8} {'pages':>6} {'reads':>6} {'lag p50':>8} {'lag p99':>8} {'lag max':>8} "
+              f"{'read p50':>9} {'read p99':>9}")
+        for offload in ('none', 'thread', 'process'):
+            r = asyncio.run(run(port, args.duration, offload))
+            print(f"{offload:<8} {r['pages']:>6} {r['reads']:>6} {r['lag_p50_ms']:>8.2f} {r['lag_p99_ms']:>8.2f} "
+                  f"{r['lag_max_ms']:>8.2f} {r['read_p50_ms']:>9.2f} {r['read_p99_ms']:>9.2f}")
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,20 @@
+import asyncio
+import base64
 import datetime
+import gzip
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 from aio_cosmos import __version__, auth
-from aio_cosmos.client import CosmosClient, get_client
+from aio_cosmos.aggregation import is_distinct_query, parse_aggregate_query
+from aio_cosmos.circuit import CircuitBreakerPolicy, CircuitState
+from aio_cosmos.client import CircuitOpenError, CosmosClient, CosmosError, CosmosTimeoutError, get_client, query_shape
+from aio_cosmos.export import RangeSplitError, export_container
+from aio_cosmos.hedging import HedgingPolicy
+from aio_cosmos.limiter import Priority, RULimiter
+from aio_cosmos.query_metrics import QueryMetrics, parse_index_metrics
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 import os
 import pytest
 
@@ -92,3 +105,503 @@ def i_test_create_db_az():
     #database.delete_container('test-container-sync')
     #client.delete_database(f'test-az-sync-{number}')
 
+
+KEY = base64.b64encode(b'key').decode()
+
+
+def fake_gateway(*routes, partition_key_path='/account', ranges=('0',)) -> TestServer:
+    """A local stand-in for the gateway serving the account, container db/coll and its partition key ranges.
+
+    Each route is a (method, path, handler) tuple. Metadata requests are recorded in server.metadata_calls.
+    """
+    metadata_calls = []
+
+    async def get_account(request):
+        metadata_calls.append('account')
+        endpoint = str(request.url.origin())
+        return web.json_response({'writableLocations': [{'databaseAccountEndpoint': endpoint}],
+                                  'readableLocations': [{'databaseAccountEndpoint': endpoint}]})
+
+    async def get_container(request):
+        metadata_calls.append('container')
+        return web.json_response({'id': 'coll', 'partitionKey': {'paths': [partition_key_path], 'kind': 'Hash'}})
+
+    async def get_ranges(request):
+        metadata_calls.append('pkranges')
+        return web.json_response({'PartitionKeyRanges': [{'id': r, 'parents': []} for r in ranges]})
+
+    app = web.Application()
+    app.router.add_get('/', get_account)
+    app.router.add_get('/dbs/db/colls/coll', get_container)
+    app.router.add_get('/dbs/db/colls/coll/pkranges', get_ranges)
+    for method, path, handler in routes:
+        app.router.add_route(method, path, handler)
+    server = TestServer(app)
+    server.metadata_calls = metadata_calls
+    return server
+
+
+class FakeExportClient:
+
+    def __init__(self, ranges, pages, fail_after=None, gone_after=None, split_into=None):
+        self.ranges = ranges
+        self.pages = pages
+        self.fail_after = fail_after
+        self.gone_after = gone_after
+        self.split_into = split_into
+        self.served = 0
+
+    async def list_partition_key_ranges(self, database, container):
+        return {'status': 'ok', 'code': 200, 'data': self.ranges}
+
+    async def query_documents(self, database, container, query, partition_key_range_id=None,
+                              continuation=None, **kwargs):
+        index = 0 if continuation is None else int(continuation)
+        for page in self.pages[partition_key_range_id][index:]:
+            if self.fail_after is not None and self.served == self.fail_after:
+                raise ConnectionError('interrupted')
+            if self.gone_after is not None and self.served >= self.gone_after and partition_key_range_id == '0':
+                if self.split_into is not None:
+                    self.ranges = self.split_into
+                raise CosmosError(410, {}, 'Gone')
+            self.served += 1
+            index += 1
+            more = index < len(self.pages[partition_key_range_id])
+            yield {'status': 'ok', 'code': 200, 'data': page, 'continuation': str(index) if more else None}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('compress', [False, True])
+async def test_export_resumes(tmp_path, compress):
+    ranges = [{'id': '0', 'parents': []}, {'id': '1', 'parents': []}]
+    pages = {
+        '0': [[{'id': 'a'}, {'id': 'b'}], [{'id': 'c'}]],
+        '1': [[{'id': 'd'}], [{'id': 'e'}], [{'id': 'f'}]],
+    }
+
+    with pytest.raises(ConnectionError):
+        await export_container(FakeExportClient(ranges, pages, fail_after=2), 'db', 'coll', str(tmp_path),
+                               compress=compress, max_concurrency=1)
+
+    result = await export_container(FakeExportClient(ranges, pages), 'db', 'coll', str(tmp_path),
+                                    compress=compress)
+    assert result['documents'] == 6
+
+    ids = []
+    for file in result['files']:
+        with (gzip.open if compress else open)(file, 'rt') as f:
+            ids.extend(json.loads(line)['id'] for line in f)
+    assert sorted(ids) == ['a', 'b', 'c', 'd', 'e', 'f']
+
+
+@pytest.mark.asyncio
+async def test_export_continues_split_range(tmp_path):
+    ranges = [{'id': '0', 'parents': []}]
+    # the children continue from the parent's continuation, so their first page is never read
+    pages = {'0': [[{'id': 'a'}], [{'id': 'x'}]], '1': [[], [{'id': 'b'}]], '2': [[], [{'id': 'c'}]]}
+    children = [{'id': '1', 'parents': ['0']}, {'id': '2', 'parents': ['0']}]
+
+    client = FakeExportClient(ranges, pages, gone_after=1, split_into=children)
+    result = await export_container(client, 'db', 'coll', str(tmp_path))
+    assert result['documents'] == 3
+    assert str(tmp_path / 'coll-range-0.ndjson') in result['files']
+
+    ids = []
+    for file in result['files']:
+        with open(file) as f:
+            ids.extend(json.loads(line)['id'] for line in f)
+    assert sorted(ids) == ['a', 'b', 'c']
+
+    # a 410 for a range that has not split is retried a bounded number of times
+    client = FakeExportClient(ranges, pages, gone_after=0)
+    with pytest.raises(RangeSplitError):
+        await export_container(client, 'db', 'coll', str(tmp_path / 'gone'), max_gone_retries=1)
+
+
+@pytest.mark.asyncio
+async def test_ru_limiter_prioritises_interactive():
+    limiter = RULimiter(100, default_cost=40)
+    cost = await limiter.acquire('write', Priority.Background)
+    limiter.record('write', cost, 60)
+    assert limiter.estimate('write') == 60
+
+    order = []
+
+    async def request(operation, priority):
+        await limiter.acquire(operation, priority)
+        order.append(priority)
+
+    await asyncio.gather(request('write', Priority.Background), request('read', Priority.Interactive),
+                         request('read', Priority.Interactive))
+    assert order == [Priority.Interactive, Priority.Interactive, Priority.Background]
+    stats = limiter.stats()
+    assert stats['queue_depth'] == {Priority.Interactive: 0, Priority.Background: 0}
+    assert stats['priorities'][Priority.Background]['waited'] == 1
+
+
+def test_operation_keys_are_bounded():
+    assert query_shape("SELECT * FROM c WHERE c.account = 'a' AND c.n > 1") == \
+        query_shape("select *  from c where c.account = 'b' and c.n > 22")
+
+    limiter = RULimiter(100, max_operations=2)
+    policy = HedgingPolicy(max_operations=2)
+    for operation in ('a', 'b', 'c'):
+        limiter.record(operation, 5, 5)
+        policy.record(operation, 0.01)
+    assert list(limiter.estimates) == ['b', 'c']
+    assert list(policy.latencies) == ['b', 'c']
+
+
+@pytest.mark.asyncio
+async def test_hedged_read_wins_over_stalled_request():
+    calls = []
+
+    async def get_doc(request):
+        calls.append(request.path)
+        if len(calls) == 1:
+            await asyncio.sleep(5)
+        return web.json_response({'id': request.match_info['doc_id']})
+
+    async with fake_gateway(('GET', '/dbs/db/colls/coll/docs/{doc_id}', get_doc)) as server:
+        policy = HedgingPolicy(initial_threshold=0.05)
+        client = CosmosClient(str(server.make_url('')), KEY, hedging=policy)
+        try:
+            res = await asyncio.wait_for(client.get_document('db', 'coll', 'doc-1', partition_key='pk'), 2)
+        finally:
+            await client.close()
+
+    assert res['data'] == {'id': 'doc-1'}
+    assert len(calls) == 2
+    assert policy.stats()['hedges'] == 1
+    assert policy.stats()['hedge_wins'] == 1
+
+
+@pytest.mark.asyncio
+async def test_hedged_requests_are_charged_to_ru_budget():
+    calls = []
+
+    async def get_doc(request):
+        calls.append(request.path)
+        if len(calls) == 1:
+            await asyncio.sleep(0.1)
+            return web.json_response({'code': 'ServiceUnavailable'}, status=503, headers={'x-ms-request-charge': '2'})
+        await asyncio.sleep(0.2)
+        return web.json_response({'id': 'doc-1'}, headers={'x-ms-request-charge': '3'})
+
+    async with fake_gateway(('GET', '/dbs/db/colls/coll/docs/{doc_id}', get_doc)) as server:
+        limiter = RULimiter(1000)
+        client = CosmosClient(str(server.make_url('')), KEY, ru_limiter=limiter,
+                              hedging=HedgingPolicy(initial_threshold=0.05))
+        try:
+            res = await client.get_document('db', 'coll', 'doc-1', partition_key='pk')
+        finally:
+            await client.close()
+
+    assert res['data'] == {'id': 'doc-1'}
+    assert limiter.stats()['ru_charged'] == 5
+
+
+@pytest.mark.asyncio
+async def test_deadline_opens_circuit_breaker():
+    async def get_doc(request):
+        await asyncio.sleep(5)
+        return web.json_response({})
+
+    async with fake_gateway(('GET', '/dbs/db/colls/coll/docs/{doc_id}', get_doc)) as server:
+        breakers = CircuitBreakerPolicy(failure_threshold=2, reset_timeout=60, min_attempt_timeout=0.04)
+        client = CosmosClient(str(server.make_url('')), KEY, timeout=0.05,
+                              circuit_breaker=breakers)
+        try:
+            # a caller's own tight deadline does not count against the endpoint
+            for _ in range(3):
+                with pytest.raises(CosmosTimeoutError):
+                    await client.get_document('db', 'coll', 'doc-1', partition_key='pk', timeout=0.01)
+            assert [b['failures'] for b in breakers.stats().values()] == [0]
+
+            for _ in range(2):
+                with pytest.raises(CosmosTimeoutError):
+                    await client.get_document('db', 'coll', 'doc-1', partition_key='pk')
+            with pytest.raises(CircuitOpenError):
+                await client.get_document('db', 'coll', 'doc-1', partition_key='pk')
+        finally:
+            await client.close()
+
+    stats = breakers.stats()
+    assert [b['state'] for b in stats.values()] == [CircuitState.Open]
+
+
+@pytest.mark.asyncio
+async def test_partition_key_from_cached_container_metadata():
+    partition_keys = []
+
+    async def create_doc(request):
+        partition_keys.append(request.headers['x-ms-documentdb-partitionkey'])
+        return web.json_response(await request.json(), status=201)
+
+    async with fake_gateway(('POST', '/dbs/db/colls/coll/docs', create_doc),
+                            partition_key_path='/tenant/id') as server:
+        async with get_client(str(server.make_url('')), KEY, metadata_ttl=None) as client:
+            assert client.metadata.ttl is None
+            await client.create_document('db', 'coll', {'id': '1', 'tenant': {'id': 'a'}})
+            await client.create_documents('db', 'coll', [{'id': '2', 'tenant': {'id': 'b'}},
+                                                         ({'id': '3', 'tenant': {'id': 'c'}}, 'c')])
+            await client.create_document('db', 'coll', {'id': '4', 'tenant': {'id': 7}})
+            await client.create_document('db', 'coll', {'id': '5', 'tenant': {'id': 'say "hi"'}})
+            assert client.metadata.stats()['misses'] == 2
+
+    assert partition_keys == ['["a"]', '["b"]', '["c"]', '[7]', '["say \\"hi\\""]']
+    assert sorted(server.metadata_calls) == ['account', 'container', 'pkranges']
+
+
+def test_parse_aggregate_query():
+    aggregate = parse_aggregate_query("SELECT VALUE AVG(c.price) FROM c WHERE c.tags IN ('a', 'b')")
+    assert aggregate.function == 'AVG'
+    assert [f for f, _ in aggregate.partition_queries()] == ['SUM', 'COUNT']
+    assert aggregate.partition_queries()[1][1] == "SELECT VALUE COUNT(c.price) FROM c WHERE c.tags IN ('a', 'b')"
+    assert parse_aggregate_query('select count(1) as total from c').alias == 'total'
+    assert parse_aggregate_query('SELECT VALUE COUNT(1) FROM c GROUP BY c.account') is None
+    assert parse_aggregate_query('SELECT * FROM c') is None
+    assert is_distinct_query('SELECT DISTINCT VALUE c.account FROM c')
+    assert parse_aggregate_query('SELECT VALUE COUNT(1) FROM c WHERE c.top = true') is not None
+    assert parse_aggregate_query('SELECT VALUE COUNT(1) FROM c WHERE c.offset > 0') is not None
+    assert parse_aggregate_query("SELECT VALUE COUNT(1) FROM c WHERE CONTAINS(c.name, 'TOP')") is not None
+    assert parse_aggregate_query("SELECT VALUE COUNT(1) FROM c WHERE c.name = 'top' ORDER BY c.n") is None
+    assert is_distinct_query("SELECT DISTINCT VALUE c.account FROM c WHERE c['order by'] = 'group by'")
+    assert not is_distinct_query('SELECT DISTINCT TOP 10 c.account FROM c')
+
+
+@pytest.mark.asyncio
+async def test_cross_partition_aggregate_and_distinct():
+    partitions = {'0': [{'account': 'a', 'price': 1}, {'account': 'b', 'price': 2}],
+                  '1': [{'account': 'b', 'price': 6}]}
+
+    async def query(request):
+        docs = partitions[request.headers['x-ms-documentdb-partitionkeyrangeid']]
+        text = (await request.json())['query']
+        if text.startswith('SELECT VALUE SUM'):
+            result = [sum(d['price'] for d in docs)]
+        elif text.startswith('SELECT VALUE COUNT'):
+            result = [len(docs)]
+        else:
+            result = list({d['account'] for d in docs})
+        return web.json_response({'Documents': result})
+
+    async with fake_gateway(('POST', '/dbs/db/colls/coll/docs', query), ranges=tuple(partitions)) as server:
+        client = CosmosClient(str(server.make_url('')), KEY)
+        try:
+            pages = [p async for p in client.query_documents('db', 'coll', 'SELECT VALUE AVG(c.price) FROM c',
+                                                             enable_cross_partition_query=True)]
+            assert [p['data'] for p in pages] == [[3]]
+
+            pages = [p async for p in client.query_documents('db', 'coll', 'SELECT DISTINCT VALUE c.account FROM c',
+                                                             enable_cross_partition_query=True)]
+            assert sorted(v for p in pages for v in p['data']) == ['a', 'b']
+        finally:
+            await client.close()
+
+
+def test_query_metrics():
+    header = ('totalExecutionTimeInMs=33.67;queryCompileTimeInMs=0.06;indexLookupTimeInMs=0.99;'
+              'documentLoadTimeInMs=9.58;retrievedDocumentCount=2000;retrievedDocumentSize=1125600;'
+              'outputDocumentCount=20;outputDocumentSize=11256;indexUtilizationRatio=0.01')
+    first = QueryMetrics.parse(header, '512.4')
+    assert first.retrieved_document_count == 2000
+    assert first.output_document_count == 20
+    assert first.request_charge == 512.4
+
+    total = first + QueryMetrics.parse('retrievedDocumentCount=2000;indexUtilizationRatio=1.00', '10')
+    assert total.retrieved_document_count == 4000
+    assert total.index_hit_ratio == pytest.approx(0.505)
+    assert total.to_dict()['request_charge'] == pytest.approx(522.4)
+
+    utilization = {'UtilizedSingleIndexes': [], 'PotentialCompositeIndexes': [{'IndexSpecs': ['/a ASC', '/b ASC']}]}
+    assert parse_index_metrics(base64.b64encode(json.dumps(utilization).encode()).decode()) == utilization
+
+
+@pytest.mark.asyncio
+async def test_query_documents_populates_metrics():
+    seen = []
+    utilization = base64.b64encode(json.dumps({'UtilizedSingleIndexes': [{'FilterExpression': '(c.a = 1)'}]})
+                                   .encode()).decode()
+
+    async def query(request):
+        seen.append((request.headers.get('x-ms-documentdb-populatequerymetrics'),
+                     request.headers.get('x-ms-cosmos-populateindexmetrics')))
+        headers = {'x-ms-request-charge': '2.5', 'x-ms-cosmos-index-utilization': utilization,
+                   'x-ms-documentdb-query-metrics': 'retrievedDocumentCount=10;outputDocumentCount=1'}
+        if 'x-ms-continuation' not in request.headers:
+            headers['x-ms-continuation'] = 'next'
+        return web.json_response({'Documents': [{'id': str(len(seen))}]}, headers=headers)
+
+    async with fake_gateway(('POST', '/dbs/db/colls/coll/docs', query)) as server:
+        client = CosmosClient(str(server.make_url('')), KEY, metadata_ttl=None)
+        try:
+            pages = [p async for p in client.query_documents('db', 'coll', 'SELECT * FROM c WHERE c.a = 1',
+                                                             partition_key='a', populate_query_metrics=True)]
+        finally:
+            await client.close()
+
+    assert seen == [('True', 'True'), ('True', 'True')]
+    assert [p['query_metrics'].retrieved_document_count for p in pages] == [10, 10]
+    assert [p['total_query_metrics'].retrieved_document_count for p in pages] == [10, 20]
+    assert pages[1]['total_query_metrics'].request_charge == 5.0
+    assert pages[1]['index_metrics']['UtilizedSingleIndexes'][0]['FilterExpression'] == '(c.a = 1)'
+
+
+@pytest.mark.asyncio
+async def test_write_coalescing():
+    async def create_doc(request):
+        doc = await request.json()
+        if doc['id'] == 'conflict':
+            return web.json_response({'code': 'Conflict', 'message': 'exists'}, status=409)
+        return web.json_response(doc, status=201, headers={'x-ms-session-token': '0:1#9'})
+
+    async with fake_gateway(('POST', '/dbs/db/colls/coll/docs', create_doc)) as server:
+        async with get_client(str(server.make_url('')), KEY) as client:
+            writer = client.enable_write_coalescing(max_batch=4, max_delay=0.05)
+            futures = [writer.submit('db', 'coll', {'id': str(i), 'account': 'a'}) for i in range(5)]
+            futures.append(writer.submit('db', 'coll', {'id': 'conflict', 'account': 'a'}))
+            futures.append(writer.submit('db', 'coll', {'id': 'nokey'}))
+            results = await asyncio.gather(*futures, return_exceptions=True)
+
+            assert [r['data']['id'] for r in results[:5]] == ['0', '1', '2', '3', '4']
+            assert results[5]['status'] == 'failed' and results[5]['code'] == 409
+            assert isinstance(results[6], ValueError)
+            assert writer.stats()['batches'] == 2
+            assert client.session_token == '0:1#9'
+            assert client.enable_write_coalescing() is writer
+
+            # with one batch allowed in flight, submit refuses a second and write waits for room
+            writer.max_queued_batches, writer.max_batch = 1, 1
+            first = writer.submit('db', 'coll', {'id': 'q1', 'account': 'a'})
+            with pytest.raises(asyncio.QueueFull):
+                writer.submit('db', 'coll', {'id': 'q2', 'account': 'a'})
+            second = await writer.write('db', 'coll', {'id': 'q2', 'account': 'a'})
+            assert (await first)['data']['id'] == 'q1' and second['data']['id'] == 'q2'
+
+
+@pytest.mark.asyncio
+async def test_no_response_on_write():
+    async def create_doc(request):
+        headers = {'etag': '"0001"', 'x-ms-request-charge': '6.1', 'x-ms-session-token': '0:1#5'}
+        if request.headers.get('Prefer') == 'return=minimal':
+            return web.Response(status=201, headers=headers)
+        return web.json_response(await request.json(), status=201, headers=headers)
+
+    async with fake_gateway(('POST', '/dbs/db/colls/coll/docs', create_doc)) as server:
+        client = CosmosClient(str(server.make_url('')), KEY, metadata_ttl=None,
+                              no_response_on_write=True)
+        await client.connect()
+        try:
+            res = await client.create_document('db', 'coll', {'id': '1'}, partition_key='a')
+            assert res['data'] is None
+            assert (res['etag'], res['request_charge'], res['session_token']) == ('"0001"', 6.1, '0:1#5')
+
+            res = await client.create_documents('db', 'coll', [({'id': '2'}, 'a'), ({'id': '3'}, 'a')])
+            assert [r['data'] for r in res] == [None, None]
+            assert [r['etag'] for r in res] == ['"0001"', '"0001"']
+
+            res = await client.create_document('db', 'coll', {'id': '4'}, partition_key='a', no_response=False)
+            assert res['data'] == {'id': '4'}
+        finally:
+            await client.close()
+
+
+@pytest.mark.asyncio
+async def test_delete_documents_by_query():
+    docs = [{'id': str(i), 'account': 'a' if i % 2 else 'b'} for i in range(25)]
+    deleted, throttled = [], {}
+    in_flight, peak = 0, 0
+    loop = asyncio.get_event_loop()
+
+    async def query(request):
+        start = int(request.headers.get('x-ms-continuation', 0))
+        size = int(request.headers['x-ms-max-item-count'])
+        headers = {'x-ms-request-charge': '3'}
+        if start + size < len(docs):
+            headers['x-ms-continuation'] = str(start + size)
+        return web.json_response({'Documents': docs[start:start + size]}, headers=headers)
+
+    async def delete_doc(request):
+        nonlocal in_flight, peak
+        doc_id = request.match_info['doc_id']
+        if doc_id == '7' and doc_id not in throttled:
+            throttled[doc_id] = loop.time()
+            return web.json_response({'code': 'TooManyRequests'}, status=429, headers={'x-ms-retry-after-ms': '200'})
+        if doc_id == '7':
+            throttled[doc_id] = loop.time() - throttled[doc_id]
+        if doc_id == '11':
+            return web.json_response({'code': 'InternalServerError'}, status=500, headers={'x-ms-request-charge': '1'})
+        if doc_id == '9':
+            return web.json_response({'code': 'NotFound'}, status=404, headers={'x-ms-request-charge': '1'})
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        deleted.append((doc_id, request.headers['x-ms-documentdb-partitionkey']))
+        return web.Response(status=204, headers={'x-ms-request-charge': '5'})
+
+    async with fake_gateway(('POST', '/dbs/db/colls/coll/docs', query),
+                            ('DELETE', '/dbs/db/colls/coll/docs/{doc_id}', delete_doc)) as server:
+        async with get_client(str(server.make_url('')), KEY, raise_on_failure=True) as client:
+            progress = []
+            res = await client.delete_documents('db', 'coll', 'SELECT c.id, c.account FROM c', max_concurrency=4,
+                                                page_size=10, on_progress=progress.append)
+
+            docs = [{'id': 'x', 'account': 'a'}, {'id': 'no-key'}]
+            partial = await client.delete_documents('db', 'coll', 'SELECT c.id, c.account FROM c')
+
+    assert res['status'] == 'failed' and 'HTTP 500' in res['error']
+    assert (res['matched'], res['deleted'], res['not_found'], res['errors'], res['throttled']) == (25, 23, 1, 1, 1)
+    assert res['request_charge'] == 3 * 3 + 23 * 5 + 1 + 1
+    assert throttled['7'] >= 0.2
+    assert ('3', '["a"]') in deleted and ('4', '["b"]') in deleted
+    assert peak <= 4
+    assert [p['matched'] for p in progress] == [10, 20, 25, 25]
+    assert (partial['deleted'], partial['errors'], partial['status']) == (1, 1, 'failed')
+    assert 'no-key' in partial['error']
+
+
+@pytest.mark.asyncio
+async def test_offload_large_bodies():
+    class CountingExecutor(ThreadPoolExecutor):
+        submitted = 0
+
+        def submit(self, *args, **kwargs):
+            self.submitted += 1
+            return super().submit(*args, **kwargs)
+
+    bodies = []
+
+    async def get_doc(request):
+        doc_id = request.match_info['doc_id']
+        return web.json_response({'id': doc_id, 'padding': 'x' * int(doc_id)})
+
+    async def create_doc(request):
+        bodies.append((request.content_type, await request.json()))
+        return web.json_response({}, status=201)
+
+    executor = CountingExecutor(max_workers=2)
+    async with fake_gateway(('GET', '/dbs/db/colls/coll/docs/{doc_id}', get_doc),
+                            ('POST', '/dbs/db/colls/coll/docs', create_doc)) as server:
+        client = CosmosClient(str(server.make_url('')), KEY, metadata_ttl=None,
+                              offload_threshold=1000, offload_executor=executor)
+        try:
+            assert (await client.get_document('db', 'coll', '10', partition_key='a'))['data']['id'] == '10'
+            assert executor.submitted == 0
+            assert (await client.get_document('db', 'coll', '2000', partition_key='a'))['data']['id'] == '2000'
+            assert executor.submitted == 1
+
+            await client.create_documents('db', 'coll', [({'id': '1'}, 'a'), ({'id': '2'}, 'a')])
+            assert executor.submitted == 1
+            large = [({'id': str(i), 'padding': 'x' * 500}, 'a') for i in range(4)]
+            await client.create_documents('db', 'coll', large)
+            assert executor.submitted == 2
+        finally:
+            await client.close()
+
+    assert sorted(b['id'] for _, b in bodies) == ['0', '1', '1', '2', '2', '3']
+    assert {content_type for content_type, _ in bodies} == {'application/json'}
+    # an executor passed in is left for its owner to shut down
+    assert executor.submit(int, '1').result() == 1
+    executor.shutdown()